@@ -6,6 +6,13 @@ import subprocess
 import re
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import artifactregistry_v1
+
+# Maximum number of tag lookups in flight at once
+MAX_CONCURRENT_REQUESTS = 16
 
 
 def extract_version_from_file(file_path: str) -> str | None:
@@ -30,51 +37,85 @@ def extract_version_from_file(file_path: str) -> str | None:
     return None
 
 
-def get_next_version_tag(folder: str, version: str) -> str:
+def get_repository_resource_name(base_image_path: str) -> str:
     """
-    Query GCP to list tags for the given image and determine the next available
-    version suffix for the extracted version.
+    Convert a base image path like
+    australia-southeast1-docker.pkg.dev/cpg-common/images
+    to the Artifact Registry resource name of the repository.
     """
-    base_image_path_prod = os.environ.get(
-        'GCP_BASE_IMAGE',
-        'australia-southeast1-docker.pkg.dev/cpg-common/images',
-    )
-    base_image_path_archive = os.environ.get(
-        'GCP_BASE_ARCHIVE_IMAGE',
-        'australia-southeast1-docker.pkg.dev/cpg-common/images-archive',
+    host, project, repository = base_image_path.split('/', 2)
+    location = host.removesuffix('-docker.pkg.dev')
+    return f'projects/{project}/locations/{location}/repositories/{repository}'
+
+
+def list_image_tags(
+    client: artifactregistry_v1.ArtifactRegistryClient, repository: str, image: str
+) -> list[str]:
+    """
+    List the tags of an image in a repository, none if the image doesn't exist yet.
+    """
+    request = artifactregistry_v1.ListTagsRequest(
+        parent=f'{repository}/packages/{image.replace("/", "%2F")}',
+        page_size=1000,
     )
-    full_image_name_prod = f'{base_image_path_prod}/{folder}'
-    full_image_name_archive = f'{base_image_path_archive}/{folder}'
-
-    tags_list = []
-    import logging
-
-    logging.basicConfig(level=logging.ERROR)
-    for full_image_name in [full_image_name_prod, full_image_name_archive]:
-        cmd = [
-            'gcloud',
-            'container',
-            'images',
-            'list-tags',
-            full_image_name,
-            '--format=json',
+    try:
+        return [
+            tag.name.rsplit('/', 1)[-1] for tag in client.list_tags(request=request)
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except gcp_exceptions.NotFound:
+        return []
 
-        # If existing tags are found, proceed to determine the next version.
-        tags_list += json.loads(result.stdout)
 
+def get_image_tags(images: list[str]) -> dict[str, list[str]]:
+    """
+    Query GCP for the tags of each of the given images in both the prod and archive
+    repositories. All of the lookups share one client and run concurrently.
+    """
+    if not images:
+        return {}
+
+    repositories = [
+        get_repository_resource_name(
+            os.environ.get(
+                'GCP_BASE_IMAGE',
+                'australia-southeast1-docker.pkg.dev/cpg-common/images',
+            )
+        ),
+        get_repository_resource_name(
+            os.environ.get(
+                'GCP_BASE_ARCHIVE_IMAGE',
+                'australia-southeast1-docker.pkg.dev/cpg-common/images-archive',
+            )
+        ),
+    ]
+    lookups = [(image, repository) for image in images for repository in repositories]
+
+    client = artifactregistry_v1.ArtifactRegistryClient()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        results = executor.map(
+            lambda lookup: list_image_tags(client, lookup[1], lookup[0]), lookups
+        )
+        image_tags: dict[str, list[str]] = {image: [] for image in images}
+        for (image, _), tags in zip(lookups, results, strict=True):
+            image_tags[image] += tags
+
+    return image_tags
+
+
+def get_next_version_tag(version: str, tags: list[str]) -> str:
+    """
+    Determine the next available version suffix for the extracted version, given
+    the existing tags of the image.
+    """
     max_suffix = 0
     pattern = re.compile(rf'^{re.escape(version)}-(\d+)$')
 
     # If no tags are found, it returns the next version as -1.
-    for entry in tags_list:
-        tags = entry.get('tags', [])
-        for tag in tags:
-            match = pattern.match(tag)
-            if match:
-                num = int(match.group(1))
-                max_suffix = max(max_suffix, num)
+    for tag in tags:
+        match = pattern.match(tag)
+        if match:
+            num = int(match.group(1))
+            max_suffix = max(max_suffix, num)
     new_suffix = max_suffix + 1
     return f'{version}-{new_suffix}'
 
@@ -127,7 +168,8 @@ def main():
     )
     dockerfiles = [line.split() for line in result.stdout.splitlines()]
 
-    include_entries = []
+    # (folder, version) of each changed image
+    versions: list[tuple[str, str]] = []
 
     # Constants for git diff parsing
     min_parts_normal = 2
@@ -161,10 +203,15 @@ def main():
         folder_path = os.path.dirname(dockerfile_path)
         folder = os.path.basename(folder_path) if folder_path else 'root'
 
-        # Determine the next available tag based on current_version.
-        new_tag = get_next_version_tag(folder, current_version)
+        versions.append((folder, current_version))
 
-        include_entries.append({'name': folder, 'tag': new_tag})
+    # Fetch the tags of all changed images at once, then determine the next
+    # available tag of each based on its current version.
+    image_tags = get_image_tags(sorted({folder for folder, _ in versions}))
+    include_entries = [
+        {'name': folder, 'tag': get_next_version_tag(version, image_tags[folder])}
+        for folder, version in versions
+    ]
 
     # Build the final matrix structure.
     matrix = {'include': include_entries}
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Benchmark compute_AFs.py on synthetic SV VCFs.
+
+Generates an SV VCF (plus matching fam, population and PAR files) with a
+configurable number of samples, records, multiallelic CNVs, sex chromosome
+records and populations, then annotates it with each engine and reports
+throughput, peak RSS and per-stage timings as JSON. Runs entirely offline.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+import compute_AFs
+
+AUTOSOMES = [('chr1', 248_956_422), ('chr2', 242_193_529)]
+ALLOSOMES = [('chrX', 156_040_895), ('chrY', 57_227_415)]
+PAR_REGIONS = [
+    ('chrX', 10_000, 2_781_479),
+    ('chrX', 155_701_382, 156_030_895),
+    ('chrY', 10_000, 2_781_479),
+    ('chrY', 56_887_902, 57_217_415),
+]
+MAX_CN = 5
+REF_CN = 2
+MISSING_RATE = 0.01
+DEL_FRACTION = 0.6
+
+
+def generate_samples(
+    n_samples: int, n_pops: int, rng: np.random.Generator
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    Sample IDs, with a sex ('1', '2' or '0' for unknown) and a population
+    ('.' for unassigned) for each
+    """
+    samples = [f'SAMPLE{i:06d}' for i in range(n_samples)]
+    sexes = rng.choice(['1', '2', '0'], size=n_samples, p=[0.49, 0.49, 0.02])
+    pop_names = np.array([f'POP{i}' for i in range(n_pops)] + ['.'])
+    pop_weights = np.array([0.95 / max(n_pops, 1)] * n_pops + [0.05])
+    pops = rng.choice(pop_names, size=n_samples, p=pop_weights / pop_weights.sum())
+    return samples, list(sexes), list(pops)
+
+
+def biallelic_genotypes(n_samples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    GT strings of one biallelic record, in Hardy-Weinberg proportions for a
+    random allele frequency, with some missing genotypes
+    """
+    af = rng.beta(0.5, 5)
+    probs = np.array([(1 - af) ** 2, 2 * af * (1 - af), af**2]) * (1 - MISSING_RATE)
+    probs = np.append(probs, 1 - probs.sum())
+    return rng.choice(np.array(['0/0', '0/1', '1/1', './.']), size=n_samples, p=probs)
+
+
+def multiallelic_copy_numbers(n_samples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    GT:CN strings of one multiallelic CNV record
+    """
+    probs = rng.dirichlet([1] * (MAX_CN + 1))
+    probs = 0.5 * probs + 0.5 * np.eye(MAX_CN + 1)[REF_CN]
+    cns = rng.choice(np.arange(MAX_CN + 1), size=n_samples, p=probs)
+    calls = np.char.add('./.:', cns.astype(str))
+    calls[rng.random(n_samples) < MISSING_RATE] = './.:.'
+    return calls
+
+
+def generate_vcf(
+    directory: str,
+    *,
+    n_samples: int,
+    n_records: int,
+    multiallelic_fraction: float,
+    sex_chrom_fraction: float,
+    n_pops: int,
+    seed: int = 0,
+) -> dict[str, str]:
+    """
+    Write a synthetic, indexed SV VCF and matching fam, population & PAR
+    files to a directory. Returns the paths of the files written.
+    """
+    rng = np.random.default_rng(seed)
+    samples, sexes, pops = generate_samples(n_samples, n_pops, rng)
+    paths = {
+        'vcf': os.path.join(directory, 'synthetic.vcf.gz'),
+        'famfile': os.path.join(directory, 'synthetic.fam'),
+        'popfile': os.path.join(directory, 'synthetic.pops.tsv'),
+        'par': os.path.join(directory, 'synthetic.par.bed'),
+    }
+
+    with open(paths['famfile'], 'w') as fam:
+        for sample, sex in zip(samples, sexes, strict=True):
+            fam.write(f'{sample}\t{sample}\t0\t0\t{sex}\t-9\n')
+    with open(paths['popfile'], 'w') as popfile:
+        for sample, pop in zip(samples, pops, strict=True):
+            popfile.write(f'{sample}\t{pop}\n')
+    with open(paths['par'], 'w') as par:
+        for chrom, start, end in PAR_REGIONS:
+            par.write(f'{chrom}\t{start}\t{end}\n')
+
+    header = [
+        '##fileformat=VCFv4.2',
+        *(
+            f'##contig=<ID={chrom},length={length}>'
+            for chrom, length in AUTOSOMES + ALLOSOMES
+        ),
+        '##ALT=<ID=DEL,Description="Deletion">',
+        '##ALT=<ID=DUP,Description="Duplication">',
+        '##ALT=<ID=CNV,Description="Copy number variable region">',
+        '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">',
+        '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">',
+        '##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of the variant">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=CN,Number=1,Type=Integer,Description="Predicted copy number">',
+        '#'
+        + '\t'.join(
+            [
+                *('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO'),
+                'FORMAT',
+                *samples,
+            ]
+        ),
+    ]
+
+    # Spread records across chromosomes, sex chromosomes getting their fraction
+    n_sex = round(n_records * sex_chrom_fraction)
+    counts = {chrom: 0 for chrom, _ in AUTOSOMES + ALLOSOMES}
+    for chrom in rng.choice([c for c, _ in AUTOSOMES], size=n_records - n_sex):
+        counts[chrom] += 1
+    for chrom in rng.choice([c for c, _ in ALLOSOMES], size=n_sex):
+        counts[chrom] += 1
+
+    alt_cns = ','.join(f'<CN{cn}>' for cn in range(MAX_CN + 1) if cn != REF_CN)
+    with pysam.BGZFile(paths['vcf'], 'wb') as vcf:
+        vcf.write(('\n'.join(header) + '\n').encode())
+        for chrom, length in AUTOSOMES + ALLOSOMES:
+            positions = np.sort(rng.integers(1, length - 100_000, size=counts[chrom]))
+            for i, pos in enumerate(positions):
+                svlen = int(rng.integers(50, 100_000))
+                if rng.random() < multiallelic_fraction:
+                    svtype, alt, fmt = 'CNV', alt_cns, 'GT:CN'
+                    calls = multiallelic_copy_numbers(n_samples, rng)
+                else:
+                    svtype = 'DEL' if rng.random() < DEL_FRACTION else 'DUP'
+                    alt, fmt = f'<{svtype}>', 'GT'
+                    calls = biallelic_genotypes(n_samples, rng)
+                info = f'END={pos + svlen};SVTYPE={svtype};SVLEN={svlen}'
+                fields = [chrom, str(pos), f'{chrom}_{svtype}_{i}', 'N', alt]
+                fields += ['.', 'PASS', info, fmt]
+                vcf.write(('\t'.join(fields) + '\t' + '\t'.join(calls) + '\n').encode())
+
+    pysam.tabix_index(paths['vcf'], preset='vcf', force=True)
+    return paths
+
+
+def run_engine(
+    engine: str,
+    paths: dict[str, str],
+    results: multiprocessing.Queue,
+    profile: bool = False,
+    sample_chunk_size: int | None = None,
+):
+    """
+    Annotate the synthetic VCF with one engine, timing each stage. Runs in its
+    own process so that peak RSS is measured per engine. With profile, also
+    reports compute_AFs' own per-stage timings.
+    """
+    compute_AFs.stage_timer.enabled = profile
+    start = time.perf_counter()
+    out_path = os.path.join(os.path.dirname(paths['vcf']), f'{engine}.vcf.gz')
+
+    # Set up exactly as compute_AFs.py does for the equivalent command line
+    argv = [paths['vcf'], '--famfile', paths['famfile'], '--popfile']
+    argv += [paths['popfile'], '--par', paths['par'], out_path]
+    if engine == 'vectorized':
+        argv.append('--vectorized')
+        if sample_chunk_size is not None:
+            argv += ['--sample-chunk-size', str(sample_chunk_size)]
+    args = compute_AFs.parse_args(argv)
+    vcf = pysam.VariantFile(args.vcf)
+    annotator, _ = compute_AFs.setup_annotator(args, vcf)
+    fout = pysam.VariantFile(out_path, 'w', header=vcf.header)
+    setup = time.perf_counter() - start
+
+    stages = {'setup': setup, 'read': 0.0, 'compute': 0.0, 'write': 0.0}
+    n_records = 0
+    records = vcf.fetch()
+    while True:
+        t0 = time.perf_counter()
+        record = next(records, None)
+        t1 = time.perf_counter()
+        stages['read'] += t1 - t0
+        if record is None:
+            break
+        annotator.annotate(record)
+        t2 = time.perf_counter()
+        fout.write(record)
+        stages['write'] += time.perf_counter() - t2
+        stages['compute'] += t2 - t1
+        n_records += 1
+    fout.close()
+    elapsed = time.perf_counter() - start
+
+    results.put(
+        {
+            'engine': engine,
+            'records': n_records,
+            'seconds': elapsed,
+            'records_per_sec': n_records / elapsed if elapsed > 0 else None,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': stages,
+            'annotation_stages': compute_AFs.stage_timer.snapshot()
+            if profile
+            else None,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument(
+        '--multiallelic-fraction',
+        help='Fraction of records which are multiallelic CNVs.',
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        '--sex-chrom-fraction',
+        help='Fraction of records on chrX & chrY.',
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument('--pops', help='Number of populations.', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--engines',
+        help='Comma-separated engines to benchmark.',
+        default='python,vectorized',
+    )
+    parser.add_argument(
+        '--sample-chunk-size',
+        help="Passed to the vectorized engine, see compute_AFs.py's option.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--profile',
+        help="Also report compute_AFs.py's --profile stage timings for each engine. "
+        'Adds some overhead to the measured throughput.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--workdir',
+        help='Directory to write the synthetic inputs & outputs to. Defaults to a '
+        'temporary directory which is removed afterwards.',
+        default=None,
+    )
+    parser.add_argument(
+        '--json', help='Write results to this file as well as stdout.', default=None
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='benchmark_AFs.') as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+
+        start = time.perf_counter()
+        paths = generate_vcf(
+            workdir,
+            n_samples=args.samples,
+            n_records=args.records,
+            multiallelic_fraction=args.multiallelic_fraction,
+            sex_chrom_fraction=args.sex_chrom_fraction,
+            n_pops=args.pops,
+            seed=args.seed,
+        )
+        generate_seconds = time.perf_counter() - start
+
+        # Each engine runs in a fresh process so peak RSS isn't shared
+        context = multiprocessing.get_context('spawn')
+        runs = []
+        for engine in args.engines.split(','):
+            results = context.Queue()
+            process = context.Process(
+                target=run_engine,
+                args=(engine, paths, results, args.profile, args.sample_chunk_size),
+            )
+            process.start()
+            runs.append(results.get())
+            process.join()
+
+    report = {
+        'params': {
+            'samples': args.samples,
+            'records': args.records,
+            'multiallelic_fraction': args.multiallelic_fraction,
+            'sex_chrom_fraction': args.sex_chrom_fraction,
+            'pops': args.pops,
+            'seed': args.seed,
+            'sample_chunk_size': args.sample_chunk_size,
+        },
+        'environment': {
+            'image_version': os.environ.get('VERSION'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pysam': pysam.__version__,
+        },
+        'generate_seconds': generate_seconds,
+        'runs': runs,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,28 @@ Compute allele frequencies for sex & population combinations given an SV VCF
 
 import sys
 import argparse
+import bisect
+import contextlib
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
 import pysam  # type: ignore
 from svtk import utils as svu  # type: ignore
-from collections import Counter
-import pybedtools as pbt  # type: ignore
+from collections import Counter, defaultdict
+import numpy as np
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except ImportError:
+    pa = pq = None
 
 
 def create_pop_dict(popfile):
@@ -27,40 +45,262 @@ def create_pop_dict(popfile):
     return pop_dict
 
 
+class ParIndex:
+    """
+    In-memory index of pseudoautosomal regions, keyed by chromosome.
+    Overlapping intervals are merged on load so that each chromosome holds
+    sorted, disjoint intervals which can be binary searched.
+    """
+
+    def __init__(self, intervals=()):
+        by_chrom = defaultdict(list)
+        for chrom, start, end in intervals:
+            by_chrom[chrom].append((start, end))
+
+        self.starts = {}
+        self.ends = {}
+        for chrom, chrom_intervals in by_chrom.items():
+            merged = []
+            for start, end in sorted(chrom_intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[chrom] = [start for start, _ in merged]
+            self.ends[chrom] = [end for _, end in merged]
+
+    @classmethod
+    def from_bed(cls, path):
+        """
+        Load the first three columns of a plain or gzipped BED file, ignoring
+        header lines
+        """
+        intervals = []
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'rt') as bed:
+            for line in bed:
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                fields = line.split()
+                intervals.append((fields[0], int(fields[1]), int(fields[2])))
+        return cls(intervals)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def overlaps(self, chrom, start, end):
+        """
+        Check if the half-open interval [start, end) overlaps any region by at
+        least 1bp. Zero-length intervals are treated as spanning 1bp, as bedtools
+        does.
+        """
+        starts = self.starts.get(chrom)
+        if not starts:
+            return False
+        if end == start:
+            end = start + 1
+        # Last region starting before the interval ends is the only candidate
+        i = bisect.bisect_left(starts, end) - 1
+        return i >= 0 and self.ends[chrom][i] > start
+
+
+class StageTimer:
+    """
+    Cumulative wall-clock time & number of calls per annotation stage. Disabled
+    unless profiling is requested, so timing costs nothing by default. With
+    several compute threads or processes, times are summed over all of them.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Stage times & calls as a plain dict, e.g. to return from a worker
+        process
+        """
+        with self._lock:
+            return {
+                stage: {'seconds': self.seconds[stage], 'calls': self.calls[stage]}
+                for stage in self.seconds
+            }
+
+    def reset(self):
+        with self._lock:
+            self.seconds.clear()
+            self.calls.clear()
+
+    def merge(self, snapshot):
+        for stage, totals in snapshot.items():
+            self.add(stage, totals['seconds'], totals['calls'])
+
+
+# Process-wide stage timer, enabled by --profile
+stage_timer = StageTimer()
+
+
+def timed_stage(stage):
+    """
+    Decorator adding each call of a record-level function to the stage timer.
+    stage is either a stage name or a function choosing one from the record.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(record, *args, **kwargs):
+            if not stage_timer.enabled:
+                return func(record, *args, **kwargs)
+            name = stage(record) if callable(stage) else stage
+            with stage_timer.time(name):
+                return func(record, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def calc_stage(record):
+    """
+    Stage name for calc_allele_freq, which treats biallelic & CN records differently
+    """
+    return 'calc_biallelic' if svu.is_biallelic(record) else 'calc_cn'
+
+
+class ProgressLogger:
+    """
+    Logs the number of records written, records/sec and the current position
+    to stderr, at most once every interval seconds
+    """
+
+    def __init__(self, interval, label=None):
+        self.interval = interval
+        self.label = label
+        self.n_records = 0
+        self.start = time.perf_counter()
+        self.last_log = self.start
+
+    def update(self, record):
+        self.n_records += 1
+        now = time.perf_counter()
+        if now - self.last_log >= self.interval:
+            self.last_log = now
+            self.log(now, '{0}:{1}'.format(record.chrom, record.pos))
+
+    def log(self, now=None, position=None):
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self.start
+        rate = self.n_records / elapsed if elapsed > 0 else 0
+        message = '{0:,} records in {1:.1f}s ({2:,.1f} records/sec)'.format(
+            self.n_records, elapsed, rate
+        )
+        if position is not None:
+            message += ', at ' + position
+        if self.label is not None:
+            message = self.label + ': ' + message
+        print('[compute_AFs] ' + message, file=sys.stderr, flush=True)
+
+
+def profile_summary(elapsed):
+    """
+    Summary of the stage timer for a whole run, as a JSON-serialisable dict
+    """
+
+    stages = stage_timer.snapshot()
+    n_records = stages.get('write', {}).get('calls', 0)
+    return {
+        'records': n_records,
+        'seconds': elapsed,
+        'records_per_sec': n_records / elapsed if elapsed > 0 else None,
+        'stages': stages,
+    }
+
+
+def write_profile_summary(summary, path=None):
+    """
+    Write a profile summary as JSON, or as a table to stderr if no path is given
+    """
+
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return
+
+    print(
+        '[compute_AFs] {0:,} records in {1:.1f}s ({2:,.1f} records/sec)'.format(
+            summary['records'], summary['seconds'], summary['records_per_sec'] or 0
+        ),
+        file=sys.stderr,
+    )
+    for stage, totals in sorted(
+        summary['stages'].items(), key=lambda item: -item[1]['seconds']
+    ):
+        print(
+            '[compute_AFs]   {0:<18} {1:>10.2f}s {2:>12,} calls'.format(
+                stage, totals['seconds'], totals['calls']
+            ),
+            file=sys.stderr,
+        )
+
+
+@timed_stage('in_par')
 def in_par(record, parbt):
     """
     Check if variant overlaps pseudoautosomal region
     """
 
-    # Sort start & end to handle edge cases and ensure end > start for pbt functionality
-    sstart, send = [str(x) for x in sorted([record.start, record.stop])]
-    svbt_str = '\t'.join([record.chrom, sstart, send]) + '\n'
-    svbt = pbt.BedTool(svbt_str, from_string=True)
-    if len(svbt.intersect(parbt)) > 0:
-        return True
-    else:
-        return False
+    # Sort start & end to handle edge cases where end < start
+    sstart, send = sorted([record.start, record.stop])
+    return parbt.overlaps(record.chrom, sstart, send)
 
 
+@timed_stage('update_sex_freqs')
 def update_sex_freqs(record, pop=None):
     """
     Recompute allele frequencies for variants on sex chromosomes outside of PARs
     """
 
     if pop is not None:
-        m_prefix = '_'.join([pop, 'MALE'])
-        f_prefix = '_'.join([pop, 'FEMALE'])
+        m_keys = group_info_keys('_'.join([pop, 'MALE']))
+        f_keys = group_info_keys('_'.join([pop, 'FEMALE']))
     else:
-        m_prefix = 'MALE'
-        f_prefix = 'FEMALE'
+        m_keys = group_info_keys('MALE')
+        f_keys = group_info_keys('FEMALE')
 
-    m_an = record.info.get('AN_' + m_prefix, 0)
-    m_ac = sum(record.info.get('AC_' + m_prefix, 0))
-    # m_af = sum(record.info.get('AF_' + m_prefix, 0))
+    m_an = record.info.get(m_keys['AN'], 0)
+    m_ac = sum(record.info.get(m_keys['AC'], 0))
+    # m_af = sum(record.info.get(m_keys['AF'], 0))
 
-    f_an = record.info.get('AN_' + f_prefix, 0)
-    f_ac = sum(record.info.get('AC_' + f_prefix, 0))
-    # f_af = sum(record.info.get('AF_' + f_prefix , 0))
+    f_an = record.info.get(f_keys['AN'], 0)
+    f_ac = sum(record.info.get(f_keys['AC'], 0))
+    # f_af = sum(record.info.get(f_keys['AF'], 0))
 
     adj_an = m_an + f_an
     adj_ac = m_ac + f_ac
@@ -69,18 +309,35 @@ def update_sex_freqs(record, pop=None):
     else:
         adj_af = 0
 
-    if pop is None:
-        record.info['AN'] = adj_an
-        record.info['AC'] = (adj_ac,)
-        record.info['AF'] = (adj_af,)
-    else:
-        record.info['AN_' + pop] = adj_an
-        record.info['AC_' + pop] = (adj_ac,)
-        record.info['AF_' + pop] = (adj_af,)
+    keys = group_info_keys(pop)
+    record.info[keys['AN']] = adj_an
+    record.info[keys['AC']] = (adj_ac,)
+    record.info[keys['AF']] = (adj_af,)
 
     return record
 
 
+# Last SampleGroups built by cached_sample_groups, with the arguments it was
+# built from
+_sample_groups_cache = {}
+
+
+def cached_sample_groups(samples, males_set, females_set, pop_dict, pops, no_combos):
+    """
+    SampleGroups for callers of gather_allele_freqs that don't pass one, built
+    once and reused for as long as they pass the same sample, sex & population
+    objects, as when annotating every record of a VCF
+    """
+
+    args = (samples, males_set, females_set, pop_dict, pops, no_combos)
+    cached = _sample_groups_cache.get('entry')
+    if cached is None or any(a is not b for a, b in zip(args, cached[0])):
+        # Replace the arguments & groups together, for callers in other threads
+        cached = (args, SampleGroups(*args))
+        _sample_groups_cache['entry'] = cached
+    return cached[1]
+
+
 def gather_allele_freqs(
     record,
     samples,
@@ -91,11 +348,18 @@ def gather_allele_freqs(
     pops,
     sex_chroms,
     no_combos=False,
+    groups=None,
 ):
     """
     Wrapper to compute allele frequencies for all sex & population pairings
     """
 
+    # Prefer a SampleGroups index built once per VCF over regrouping samples here
+    if groups is None:
+        groups = cached_sample_groups(
+            samples, males_set, females_set, pop_dict, pops, no_combos
+        )
+
     # Add PAR annotation to record (if optioned)
     if record.chrom in sex_chroms and len(parbt) > 0:
         if in_par(record, parbt):
@@ -128,26 +392,25 @@ def gather_allele_freqs(
     # Get allele frequencies per population
     if len(pops) > 0:
         for pop in pops:
-            pop_samps = [s for s in samples if pop_dict.get(s, None) == pop]
-            calc_allele_freq(record, pop_samps, prefix=pop)
+            calc_allele_freq(record, groups.members_of(pop), prefix=pop)
             if len(males_set) > 0 and not no_combos:
                 if record.chrom in sex_chroms and not rec_in_par:
                     calc_allele_freq(
                         record,
-                        list([s for s in pop_samps if s in males_set]),
+                        groups.members_of(pop + '_MALE'),
                         prefix=pop + '_MALE',
                         hemi=True,
                     )
                 else:
                     calc_allele_freq(
                         record,
-                        list([s for s in pop_samps if s in males_set]),
+                        groups.members_of(pop + '_MALE'),
                         prefix=pop + '_MALE',
                     )
             if len(females_set) > 0 and not no_combos:
                 calc_allele_freq(
                     record,
-                    list([s for s in pop_samps if s in females_set]),
+                    groups.members_of(pop + '_FEMALE'),
                     prefix=pop + '_FEMALE',
                 )
 
@@ -162,13 +425,82 @@ def gather_allele_freqs(
 
         # Get POPMAX AF biallelic sites only
         if svu.is_biallelic(record):
-            AFs = [record.info['AF_{0}'.format(pop)][0] for pop in pops]
+            AFs = [record.info[group_info_keys(pop)['AF']][0] for pop in pops]
             popmax = max(AFs)
             record.info['POPMAX_AF'] = popmax
 
     return record
 
 
+def write_biallelic_freqs(
+    record,
+    AN,
+    AC,
+    n_alt_count_0,
+    n_alt_count_1,
+    n_alt_count_2,
+    prefix=None,
+    hemi=False,
+):
+    """
+    Adds allele & genotype frequencies for a biallelic record to its INFO field,
+    given the raw allele and genotype counts for a group of samples
+    """
+
+    keys = group_info_keys(prefix)
+
+    # Used specifically for hemizygous sites
+    n_gts_with_gt_0_alts = n_alt_count_1 + n_alt_count_2
+
+    # Adjust hemizygous allele number and allele count, if optioned
+    if hemi:
+        AN = round(AN / 2)
+        # For hemizygous sites, AC must be the sum of all non-reference *genotypes*, not alleles
+        AC = n_gts_with_gt_0_alts
+
+    # Calculate allele frequency
+    if AN > 0:
+        AF = AC / AN
+        AF = round(AF, 6)
+    else:
+        AF = 0
+
+    # Add AN, AC, and AF to INFO field
+    record.info[keys['AN']] = AN
+    record.info[keys['AC']] = AC
+    record.info[keys['AF']] = AF
+
+    # Calculate genotype frequencies
+    n_bi_genos = n_alt_count_0 + n_alt_count_1 + n_alt_count_2
+    if n_bi_genos > 0:
+        freq_homref = n_alt_count_0 / n_bi_genos
+        freq_het = n_alt_count_1 / n_bi_genos
+        freq_homalt = n_alt_count_2 / n_bi_genos
+    else:
+        freq_homref = 0
+        freq_het = 0
+        freq_homalt = 0
+    if hemi:
+        freq_hemialt = freq_het + freq_homalt
+
+    # Add N_BI_GENOS, N_HOMREF, N_HET, N_HOMALT, FREQ_HOMREF, FREQ_HET, and FREQ_HOMALT to INFO field
+    record.info[keys['N_BI_GENOS']] = n_bi_genos
+    if hemi:
+        record.info[keys['N_HEMIREF']] = n_alt_count_0
+        record.info[keys['N_HEMIALT']] = n_gts_with_gt_0_alts
+        record.info[keys['FREQ_HEMIREF']] = freq_homref
+        record.info[keys['FREQ_HEMIALT']] = freq_hemialt
+    record.info[keys['N_HOMREF']] = n_alt_count_0
+    record.info[keys['N_HET']] = n_alt_count_1
+    record.info[keys['N_HOMALT']] = n_alt_count_2
+    record.info[keys['FREQ_HOMREF']] = freq_homref
+    record.info[keys['FREQ_HET']] = freq_het
+    record.info[keys['FREQ_HOMALT']] = freq_homalt
+
+    return record
+
+
+@timed_stage(calc_stage)
 def calc_allele_freq(record, samples, prefix=None, hemi=False):
     """
     Computes allele frequencies for a single record based on a list of samples
@@ -186,7 +518,6 @@ def calc_allele_freq(record, samples, prefix=None, hemi=False):
         n_alt_count_0 = 0
         n_alt_count_1 = 0
         n_alt_count_2 = 0
-        n_gts_with_gt_0_alts = 0  # Used specifically for hemizygous sites
         for GT in GTs:
             AN += len([allele for allele in GT if allele != '.' and allele is not None])
             AC += len(
@@ -217,7 +548,6 @@ def calc_allele_freq(record, samples, prefix=None, hemi=False):
                 == 1
             ):
                 n_alt_count_1 += 1
-                n_gts_with_gt_0_alts += 1
             if (
                 len(
                     [
@@ -229,56 +559,17 @@ def calc_allele_freq(record, samples, prefix=None, hemi=False):
                 == 2
             ):
                 n_alt_count_2 += 1
-                n_gts_with_gt_0_alts += 1
-
-        # Adjust hemizygous allele number and allele count, if optioned
-        if hemi:
-            AN = round(AN / 2)
-            # For hemizygous sites, AC must be the sum of all non-reference *genotypes*, not alleles
-            AC = n_gts_with_gt_0_alts
-
-        # Calculate allele frequency
-        if AN > 0:
-            AF = AC / AN
-            AF = round(AF, 6)
-        else:
-            AF = 0
-
-        # Add AN, AC, and AF to INFO field
-        record.info['AN' + ('_' + prefix if prefix else '')] = AN
-        record.info['AC' + ('_' + prefix if prefix else '')] = AC
-        record.info['AF' + ('_' + prefix if prefix else '')] = AF
-
-        # Calculate genotype frequencies
-        n_bi_genos = n_alt_count_0 + n_alt_count_1 + n_alt_count_2
-        if n_bi_genos > 0:
-            freq_homref = n_alt_count_0 / n_bi_genos
-            freq_het = n_alt_count_1 / n_bi_genos
-            freq_homalt = n_alt_count_2 / n_bi_genos
-        else:
-            freq_homref = 0
-            freq_het = 0
-            freq_homalt = 0
-        if hemi:
-            freq_hemialt = freq_het + freq_homalt
 
-        # Add N_BI_GENOS, N_HOMREF, N_HET, N_HOMALT, FREQ_HOMREF, FREQ_HET, and FREQ_HOMALT to INFO field
-        record.info['N_BI_GENOS' + ('_' + prefix if prefix else '')] = n_bi_genos
-        if hemi:
-            record.info['N_HEMIREF' + ('_' + prefix if prefix else '')] = n_alt_count_0
-            record.info['N_HEMIALT' + ('_' + prefix if prefix else '')] = (
-                n_gts_with_gt_0_alts
-            )
-            record.info['FREQ_HEMIREF' + ('_' + prefix if prefix else '')] = freq_homref
-            record.info['FREQ_HEMIALT' + ('_' + prefix if prefix else '')] = (
-                freq_hemialt
-            )
-        record.info['N_HOMREF' + ('_' + prefix if prefix else '')] = n_alt_count_0
-        record.info['N_HET' + ('_' + prefix if prefix else '')] = n_alt_count_1
-        record.info['N_HOMALT' + ('_' + prefix if prefix else '')] = n_alt_count_2
-        record.info['FREQ_HOMREF' + ('_' + prefix if prefix else '')] = freq_homref
-        record.info['FREQ_HET' + ('_' + prefix if prefix else '')] = freq_het
-        record.info['FREQ_HOMALT' + ('_' + prefix if prefix else '')] = freq_homalt
+        write_biallelic_freqs(
+            record,
+            AN,
+            AC,
+            n_alt_count_0,
+            n_alt_count_1,
+            n_alt_count_2,
+            prefix=prefix,
+            hemi=hemi,
+        )
 
     # Multiallelic sites should reference FORMAT:CN rather than GT
     # Compute CN_NUMBER, CN_NONREF_COUNT, CN_NONREF_FREQ, and CN_COUNT/CN_FREQ for each copy state
@@ -288,417 +579,1941 @@ def calc_allele_freq(record, samples, prefix=None, hemi=False):
         CNs = [c for c in CNs_wNones if c is not None and c not in '. NA'.split()]
 
         if len(CNs) == 0:
-            nonnull_CNs, nonref_CN_count, nonref_CN_freq = [0] * 3
-            CN_dist = (0,)
-            CN_freqs = (0,)
-            CN_status = (0,)
+            CN_dist = []
         else:
-            # Count number of samples per CN and total CNs observed
+            # Count number of samples per CN
             CN_counts = dict(Counter(CNs))
-            nonnull_CNs = len(CNs)
 
-            # Get max observed CN and enumerate counts/frequencies per CN as list starting from CN=0
+            # Get max observed CN and enumerate counts per CN as list starting from CN=0
             max_CN = max([int(k) for k, v in CN_counts.items()])
             CN_dist = [int(CN_counts.get(k, 0)) for k in range(max_CN + 1)]
-            CN_freqs = [round(v / nonnull_CNs, 6) for v in CN_dist]
-            CN_status = [s for s in range(max_CN + 1)]
-
-            # Get total non-reference CN counts and freq
-            if hemi:
-                ref_CN = 1
-            else:
-                ref_CN = 2
-            nonref_CN_count = sum(
-                [int(CN_counts.get(k, 0)) for k in range(max_CN + 1) if k != ref_CN]
-            )
-            nonref_CN_freq = round(nonref_CN_count / nonnull_CNs, 6)
 
-        # Add values to INFO field
-        record.info['CN_NUMBER' + ('_' + prefix if prefix else '')] = nonnull_CNs
-        record.info['CN_COUNT' + ('_' + prefix if prefix else '')] = tuple(CN_dist)
-        record.info['CN_FREQ' + ('_' + prefix if prefix else '')] = tuple(CN_freqs)
-        record.info['CN_STATUS' + ('_' + prefix if prefix else '')] = tuple(CN_status)
-        record.info['CN_NONREF_COUNT' + ('_' + prefix if prefix else '')] = (
-            nonref_CN_count
-        )
-        record.info['CN_NONREF_FREQ' + ('_' + prefix if prefix else '')] = (
-            nonref_CN_freq
-        )
+        write_cn_freqs(record, len(CNs), CN_dist, prefix=prefix, hemi=hemi)
 
     return record
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
-    )
-    parser.add_argument('vcf', help='Input vcf. Also accepts "stdin" and "-".')
-    parser.add_argument(
-        '-p',
-        '--popfile',
-        help='Two-column file of samples & '
-        + 'their population assignments. A "." denotes no assignment.',
-        default=None,
-    )
-    parser.add_argument(
-        '-f',
-        '--famfile',
-        help='Input .fam file (used for sex-specific AFs).',
-        default=None,
-    )
-    parser.add_argument(
-        '--no-combos',
-        help='Do not compute combinations of populations ' + 'and sexes.',
-        action='store_true',
-        default=False,
-    )
-    parser.add_argument(
-        '--allosomes-list',
-        help='TSV of sex chromosomes (used for ' + 'sex-specific AFs).',
-        default=None,
-    )
-    parser.add_argument(
-        '--par',
-        help='BED file of pseudoautosomal regions (used ' + 'for sex-specific AFs).',
-        default=None,
-    )
-    parser.add_argument('fout', help='Output vcf. Also accepts "stdout" and "-".')
-    args = parser.parse_args()
+def write_cn_freqs(record, nonnull_CNs, CN_dist, prefix=None, hemi=False):
+    """
+    Adds copy number counts & frequencies for a multiallelic record to its INFO
+    field, given the number of samples with a CN and their counts per CN from
+    CN=0 up to the max observed CN
+    """
 
-    # Open connections to input VCF
-    if args.vcf in '- stdin'.split():
-        vcf = pysam.VariantFile(sys.stdin)
+    keys = group_info_keys(prefix)
+
+    if nonnull_CNs == 0:
+        nonref_CN_count, nonref_CN_freq = [0] * 2
+        CN_dist = (0,)
+        CN_freqs = (0,)
+        CN_status = (0,)
     else:
-        vcf = pysam.VariantFile(args.vcf)
+        CN_freqs = [round(v / nonnull_CNs, 6) for v in CN_dist]
+        CN_status = [s for s in range(len(CN_dist))]
 
-    # Get list of all samples in vcf
-    samples_list = list(vcf.header.samples)
+        # Get total non-reference CN counts and freq
+        if hemi:
+            ref_CN = 1
+        else:
+            ref_CN = 2
+        nonref_CN_count = sum([v for k, v in enumerate(CN_dist) if k != ref_CN])
+        nonref_CN_freq = round(nonref_CN_count / nonnull_CNs, 6)
 
-    # Get lists of males and females
-    parbt = pbt.BedTool('', from_string=True)
-    if args.famfile is not None:
-        famfile = [line.rstrip('\n') for line in open(args.famfile)]
-        males_set = set(
-            [line.split('\t')[1] for line in famfile if line.split('\t')[4] == '1']
-        )
-        males_set = set(s for s in samples_list if s in males_set)
-        females_set = set(
-            [line.split('\t')[1] for line in famfile if line.split('\t')[4] == '2']
-        )
-        females_set = set(s for s in samples_list if s in females_set)
-        sexes = 'MALE FEMALE'.split()
-        if args.par is not None:
-            parbt = pbt.BedTool(args.par)
+    # Add values to INFO field
+    record.info[keys['CN_NUMBER']] = nonnull_CNs
+    record.info[keys['CN_COUNT']] = tuple(CN_dist)
+    record.info[keys['CN_FREQ']] = tuple(CN_freqs)
+    record.info[keys['CN_STATUS']] = tuple(CN_status)
+    record.info[keys['CN_NONREF_COUNT']] = nonref_CN_count
+    record.info[keys['CN_NONREF_FREQ']] = nonref_CN_freq
 
-    else:
-        males_set = set()
-        females_set = set()
-        sexes = list()
+    return record
 
-    # Get dictionary of populations
-    if args.popfile is not None:
-        popfile = [line.rstrip('\n') for line in open(args.popfile)]
-        pop_dict = create_pop_dict(popfile)
-        pops = list(set(pop_dict.values()))
-        pops = sorted([p for p in pops if p != '.'])
-    else:
-        pop_dict = {}
-        pops = []
 
-    # Get list of sex chromosomes, if optioned
-    if args.allosomes_list is not None:
-        sex_chroms = [l.split('\t')[0] for l in open(args.allosomes_list).readlines()]
-    else:
-        sex_chroms = 'X Y chrX chrY'.split()
+class SampleGroups:
+    """
+    Sample index for every sex & population group frequencies are reported for,
+    built once from the fam & pop files, in header sample order.
 
-    # Add relevant fields to header
-    INFO_ADD = [
-        '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles genotyped (biallelic sites only).">',
-        '##INFO=<ID=AC,Number=A,Type=Integer,Description="Number of non-reference alleles observed (biallelic sites only).">',
-        '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency (biallelic sites only).">',
-        '##INFO=<ID=N_BI_GENOS,Number=1,Type=Integer,Description="Total number of samples with complete genotypes (biallelic sites only).">',
-        '##INFO=<ID=N_HOMREF,Number=1,Type=Integer,Description="Number of samples with homozygous reference genotypes (biallelic sites only).">',
-        '##INFO=<ID=N_HET,Number=1,Type=Integer,Description="Number of samples with heterozygous genotypes (biallelic sites only).">',
-        '##INFO=<ID=N_HOMALT,Number=1,Type=Integer,Description="Number of samples with homozygous alternate genotypes (biallelic sites only).">',
-        '##INFO=<ID=FREQ_HOMREF,Number=1,Type=Float,Description="Homozygous reference genotype frequency (biallelic sites only).">',
-        '##INFO=<ID=FREQ_HET,Number=1,Type=Float,Description="Heterozygous genotype frequency (biallelic sites only).">',
-        '##INFO=<ID=FREQ_HOMALT,Number=1,Type=Float,Description="Homozygous alternate genotype frequency (biallelic sites only).">',
-        '##INFO=<ID=CN_NUMBER,Number=1,Type=Integer,Description="Total number of samples with estimated copy numbers (multiallelic CNVs only).">',
-        '##INFO=<ID=CN_COUNT,Number=.,Type=Integer,Description="Number of samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">',
-        '##INFO=<ID=CN_STATUS,Number=.,Type=Integer,Description="Copy states corresponding to CN_COUNT, CN_FREQ: 0,1,...,maximum observed copy state (multiallelic CNVs only).">',
-        '##INFO=<ID=CN_FREQ,Number=.,Type=Float,Description="Frequency of samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">',
-        '##INFO=<ID=CN_NONREF_COUNT,Number=1,Type=Integer,Description="Number of samples with non-reference copy states (multiallelic CNVs only).">',
-        '##INFO=<ID=CN_NONREF_FREQ,Number=1,Type=Float,Description="Frequency of samples with non-reference copy states (multiallelic CNVs only).">',
-    ]
-    if len(sexes) > 0:
-        for sex in sexes:
-            INFO_ADD.append(
-                '##INFO=<ID=AN_%s,Number=1,Type=Integer,Description="Total number of %s alleles genotyped (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=AC_%s,Number=A,Type=Integer,Description="Number of non-reference %s alleles observed (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=AF_%s,Number=A,Type=Float,Description="%s allele frequency (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_BI_GENOS_%s,Number=1,Type=Integer,Description="Total number of %s samples with complete genotypes (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HOMREF_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous reference genotypes (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HET_%s,Number=1,Type=Integer,Description="Number of %s samples with heterozygous genotypes (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HOMALT_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous alternate genotypes (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HOMREF_%s,Number=1,Type=Float,Description="%s homozygous reference genotype frequency (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HET_%s,Number=1,Type=Float,Description="%s heterozygous genotype frequency (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HOMALT_%s,Number=1,Type=Float,Description="%s homozygous alternate genotype frequency (biallelic sites only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NUMBER_%s,Number=1,Type=Integer,Description="Total number of %s samples with estimated copy numbers (multiallelic CNVs only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_COUNT_%s,Number=.,Type=Integer,Description="Number of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_STATUS_%s,Number=.,Type=Integer,Description="Copy states corresponding to CN_COUNT_%s, CN_FREQ_%s: 0,1,...,maximum observed copy state (multiallelic CNVs only).">'
-                % (sex, sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_FREQ_%s,Number=.,Type=Float,Description="Frequency of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NONREF_COUNT_%s,Number=1,Type=Integer,Description="Number of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                % (sex, sex)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NONREF_FREQ_%s,Number=1,Type=Float,Description="Frequency of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                % (sex, sex)
-            )
-            if sex == 'MALE':
-                INFO_ADD.append(
-                    '##INFO=<ID=N_HEMIREF_%s,Number=1,Type=Integer,Description="Number of %s samples with hemizygous reference genotypes (biallelic sites only).">'
-                    % (sex, sex)
-                )
-                INFO_ADD.append(
-                    '##INFO=<ID=N_HEMIALT_%s,Number=1,Type=Integer,Description="Number of %s samples with hemizygous alternate genotypes (biallelic sites only).">'
-                    % (sex, sex)
-                )
-                INFO_ADD.append(
-                    '##INFO=<ID=FREQ_HEMIREF_%s,Number=1,Type=Float,Description="%s hemizygous reference genotype frequency (biallelic sites only).">'
-                    % (sex, sex)
-                )
-                INFO_ADD.append(
-                    '##INFO=<ID=FREQ_HEMIALT_%s,Number=1,Type=Float,Description="%s hemizygous alternate genotype frequency (biallelic sites only).">'
-                    % (sex, sex)
-                )
-                if len(parbt) > 0:
-                    INFO_ADD.append(
-                        '##INFO=<ID=PAR,Number=0,Type=Flag,Description="Variant overlaps pseudoautosomal region.">'
-                    )
-    if len(pops) > 0:
-        INFO_ADD.append(
-            '##INFO=<ID=POPMAX_AF,Number=1,Type=Float,Description="Maximum allele frequency across any population (biallelic sites only).">'
-        )
+    Every sample is assigned to exactly one (population, sex) cell, and every
+    group is a union of cells, so per-cell counts can be summed into all groups
+    with a single matrix product. Each group is also available as a boolean
+    mask, an integer index array and a list of sample IDs.
+    """
+
+    def __init__(
+        self, samples, males_set, females_set, pop_dict, pops, no_combos=False
+    ):
+        self.samples = list(samples)
+        pops_set = set(pops)
+
+        # (pop, sex) of each sample, None where unassigned
+        sample_cells = []
+        for s in self.samples:
+            pop = pop_dict.get(s, None)
+            if s in males_set:
+                sex = 'MALE'
+            elif s in females_set:
+                sex = 'FEMALE'
+            else:
+                sex = None
+            sample_cells.append((pop if pop in pops_set else None, sex))
+
+        # Only cells which actually contain samples are tracked
+        self.cell_keys = list(dict.fromkeys(sample_cells))
+        cell_idx = {key: i for i, key in enumerate(self.cell_keys)}
+        self.n_cells = len(self.cell_keys)
+        self.cells = np.array([cell_idx[key] for key in sample_cells], dtype=np.intp)
+
+        # Groups are listed in the order calc_allele_freq has always been called,
+        # so INFO keys are written to each record in the same order
+        groups = [(None, None, None)]
+        if len(males_set) > 0:
+            groups.append(('MALE', None, 'MALE'))
+        if len(females_set) > 0:
+            groups.append(('FEMALE', None, 'FEMALE'))
         for pop in pops:
-            INFO_ADD.append(
-                '##INFO=<ID=AN_%s,Number=1,Type=Integer,Description="Total number of %s alleles genotyped (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=AC_%s,Number=A,Type=Integer,Description="Number of non-reference %s alleles observed (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=AF_%s,Number=A,Type=Float,Description="%s allele frequency (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_BI_GENOS_%s,Number=1,Type=Integer,Description="Total number of %s samples with complete genotypes (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HOMREF_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous reference genotypes (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HET_%s,Number=1,Type=Integer,Description="Number of %s samples with heterozygous genotypes (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=N_HOMALT_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous alternate genotypes (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HOMREF_%s,Number=1,Type=Float,Description="%s homozygous reference genotype frequency (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HET_%s,Number=1,Type=Float,Description="%s heterozygous genotype frequency (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=FREQ_HOMALT_%s,Number=1,Type=Float,Description="%s homozygous alternate genotype frequency (biallelic sites only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NUMBER_%s,Number=1,Type=Integer,Description="Total number of %s samples with estimated copy numbers (multiallelic CNVs only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_COUNT_%s,Number=.,Type=Integer,Description="Number of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_STATUS_%s,Number=.,Type=Integer,Description="Copy states corresponding to CN_COUNT_%s, CN_FREQ_%s: 0,1,...,maximum observed copy state (multiallelic CNVs only).">'
-                % (pop, pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_FREQ_%s,Number=.,Type=Float,Description="Frequency of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NONREF_COUNT_%s,Number=1,Type=Integer,Description="Number of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                % (pop, pop)
-            )
-            INFO_ADD.append(
-                '##INFO=<ID=CN_NONREF_FREQ_%s,Number=1,Type=Float,Description="Frequency of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                % (pop, pop)
+            groups.append((pop, pop, None))
+            if len(males_set) > 0 and not no_combos:
+                groups.append((pop + '_MALE', pop, 'MALE'))
+            if len(females_set) > 0 and not no_combos:
+                groups.append((pop + '_FEMALE', pop, 'FEMALE'))
+
+        self.prefixes = [prefix for prefix, _, _ in groups]
+        self.sexes = [sex for _, _, sex in groups]
+
+        # Frequencies on sex chromosomes are adjusted from the male & female
+        # counts of all samples & of each population, so those groups are
+        # counted even when pop x sex combinations aren't reported. Unreported
+        # groups follow the reported ones.
+        if no_combos:
+            for pop in pops:
+                if len(males_set) > 0:
+                    groups.append((pop + '_MALE', pop, 'MALE'))
+                if len(females_set) > 0:
+                    groups.append((pop + '_FEMALE', pop, 'FEMALE'))
+        self.row_prefixes = [prefix for prefix, _, _ in groups]
+        self.index = {prefix: i for i, prefix in enumerate(self.row_prefixes)}
+
+        # (group, male group row, female group row) for the sex adjustment, rows
+        # being None for sexes without samples
+        self.sex_split = []
+        for prefix in [None] + list(pops):
+            m_prefix = 'MALE' if prefix is None else prefix + '_MALE'
+            f_prefix = 'FEMALE' if prefix is None else prefix + '_FEMALE'
+            self.sex_split.append(
+                (prefix, self.index.get(m_prefix), self.index.get(f_prefix))
             )
-            if len(sexes) > 0 and not args.no_combos:
-                for sex in sexes:
-                    INFO_ADD.append(
-                        '##INFO=<ID=AN_%s,Number=1,Type=Integer,Description="Total number of %s alleles genotyped (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=AC_%s,Number=A,Type=Integer,Description="Number of non-reference %s alleles observed (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=AF_%s,Number=A,Type=Float,Description="%s allele frequency (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=N_BI_GENOS_%s,Number=1,Type=Integer,Description="Total number of %s samples with complete genotypes (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=N_HOMREF_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous reference genotypes (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=N_HET_%s,Number=1,Type=Integer,Description="Number of %s samples with heterozygous genotypes (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=N_HOMALT_%s,Number=1,Type=Integer,Description="Number of %s samples with homozygous alternate genotypes (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=FREQ_HOMREF_%s,Number=1,Type=Float,Description="%s homozygous reference genotype frequency (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=FREQ_HET_%s,Number=1,Type=Float,Description="%s heterozygous genotype frequency (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=FREQ_HOMALT_%s,Number=1,Type=Float,Description="%s homozygous alternate genotype frequency (biallelic sites only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_NUMBER_%s,Number=1,Type=Integer,Description="Total number of %s samples with estimated copy numbers (multiallelic CNVs only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_COUNT_%s,Number=.,Type=Integer,Description="Number of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_STATUS_%s,Number=.,Type=Integer,Description="Copy states corresponding to CN_COUNT_%s, CN_FREQ_%s: 0,1,...,maximum observed copy state (multiallelic CNVs only).">'
-                        % (
-                            '_'.join((pop, sex)),
-                            '_'.join((pop, sex)),
-                            '_'.join((pop, sex)),
-                        )
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_FREQ_%s,Number=.,Type=Float,Description="Frequency of %s samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_NONREF_COUNT_%s,Number=1,Type=Integer,Description="Number of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    INFO_ADD.append(
-                        '##INFO=<ID=CN_NONREF_FREQ_%s,Number=1,Type=Float,Description="Frequency of %s samples with non-reference copy states (multiallelic CNVs only).">'
-                        % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                    )
-                    if sex == 'MALE':
-                        INFO_ADD.append(
-                            '##INFO=<ID=N_HEMIREF_%s,Number=1,Type=Integer,Description="Number of %s samples with hemizygous reference genotypes (biallelic sites only).">'
-                            % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                        )
-                        INFO_ADD.append(
-                            '##INFO=<ID=N_HEMIALT_%s,Number=1,Type=Integer,Description="Number of %s samples with hemizygous alternate genotypes (biallelic sites only).">'
-                            % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                        )
-                        INFO_ADD.append(
-                            '##INFO=<ID=FREQ_HEMIREF_%s,Number=1,Type=Float,Description="%s hemizygous reference genotype frequency (biallelic sites only).">'
-                            % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                        )
-                        INFO_ADD.append(
-                            '##INFO=<ID=FREQ_HEMIALT_%s,Number=1,Type=Float,Description="%s hemizygous alternate genotype frequency (biallelic sites only).">'
-                            % ('_'.join((pop, sex)), ' '.join((pop, sex)))
-                        )
 
-    for line in INFO_ADD:
-        vcf.header.add_line(line)
+        # Group x cell membership
+        self.matrix = np.zeros((len(groups), self.n_cells), dtype=np.int64)
+        for i, (_, pop, sex) in enumerate(groups):
+            for c, (cell_pop, cell_sex) in enumerate(self.cell_keys):
+                if (pop is None or cell_pop == pop) and (
+                    sex is None or cell_sex == sex
+                ):
+                    self.matrix[i, c] = 1
 
-    # Prep output VCF
-    if args.fout in '- stdout'.split():
-        fout = pysam.VariantFile(sys.stdout, 'w', header=vcf.header)
-    else:
-        fout = pysam.VariantFile(args.fout, 'w', header=vcf.header)
+        # Group x sample membership
+        self.masks = self.matrix[:, self.cells].astype(bool)
+        self.indices = [np.flatnonzero(mask) for mask in self.masks]
+        self.members = [[self.samples[i] for i in idx] for idx in self.indices]
+        self.empty = [len(idx) == 0 for idx in self.indices]
 
-    # Get allele frequencies for each record & write to new VCF
-    for r in vcf.fetch():
-        newrec = gather_allele_freqs(
-            r,
-            samples_list,
-            males_set,
-            females_set,
-            parbt,
-            pop_dict,
-            pops,
-            sex_chroms,
-            args.no_combos,
-        )
-        fout.write(newrec)
+    def sex_adjusted_freqs(self, counts):
+        """
+        AN, AC & AF of all samples & of each population on sex chromosomes
+        outside of PARs, from the raw GenotypeEncoder.COUNTS of every group.
+        Males are counted as hemizygous, as update_sex_freqs does with the
+        values written by calc_allele_freq.
+        """
+        adjusted = []
+        for prefix, m_row, f_row in self.sex_split:
+            adj_an = 0
+            adj_ac = 0
+            if m_row is not None:
+                m_an, _, _, m_het, m_homalt = counts[m_row]
+                adj_an += round(m_an / 2)
+                adj_ac += m_het + m_homalt
+            if f_row is not None:
+                f_an, f_ac, _, _, _ = counts[f_row]
+                adj_an += f_an
+                adj_ac += f_ac
+            if adj_an > 0:
+                adj_af = adj_ac / adj_an
+            else:
+                adj_af = 0
+            adjusted.append((prefix, adj_an, adj_ac, adj_af))
+        return adjusted
 
-    fout.close()
+    def members_of(self, prefix):
+        """
+        Sample IDs belonging to the group with this INFO prefix
+        """
+        return self.members[self.index[prefix]]
+
+    @property
+    def empty_groups(self):
+        """
+        INFO prefixes of groups without any samples
+        """
+        return [prefix for prefix, empty in zip(self.prefixes, self.empty) if empty]
+
+
+def sample_values(record, key, start=0, stop=None):
+    """
+    Values of a FORMAT field for samples start to stop (all samples by
+    default), only creating pysam sample objects for that range
+    """
+    samples = record.samples
+    if start == 0 and stop is None:
+        return [sample[key] for sample in samples.values()]
+    return [samples[i][key] for i in range(start, stop)]
+
+
+class GenotypeEncoder:
+    """
+    Decodes the GTs of a record into a single array of small integer genotype
+    codes. Each distinct GT tuple is only inspected once per run; its allele &
+    genotype counts are cached as a row of a lookup table indexed by code.
+    """
+
+    # Columns of the lookup table
+    COUNTS = ('AN', 'AC', 'N_HOMREF', 'N_HET', 'N_HOMALT')
+
+    def __init__(self, sample_chunk_size=None):
+        self.codes = {}
+        self.table = np.zeros((0, len(self.COUNTS)), dtype=np.int64)
+        # Decode at most this many samples' genotypes at a time, if set
+        self.sample_chunk_size = sample_chunk_size
+        self._lock = threading.Lock()
+        self._buffers = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_buffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._buffers = threading.local()
+
+    def _add(self, GT):
+        """
+        Register a new GT tuple, using the same rules as calc_allele_freq
+        """
+        with self._lock:
+            if GT in self.codes:
+                return self.codes[GT]
+            called = [allele for allele in GT if allele != '.' and allele is not None]
+            n_ref = len([allele for allele in called if allele == 0])
+            n_alt = len(called) - n_ref
+            row = (
+                len(called),
+                n_alt,
+                int(GT == (0, 0)),
+                int(n_ref == 1 and n_alt == 1),
+                int(n_alt == 2),
+            )
+            # Grow the table before publishing the code, so other threads never
+            # see a code without its row
+            self.table = np.vstack([self.table, np.array(row, dtype=np.int64)])
+            self.codes[GT] = len(self.table) - 1
+            return self.codes[GT]
+
+    def encode(self, record, start=0, stop=None):
+        """
+        Returns the genotype code of every sample (or of samples start to
+        stop), in header sample order
+        """
+        codes = self.codes
+        GTs = sample_values(record, 'GT', start, stop)
+        return np.fromiter(
+            (codes[GT] if GT in codes else self._add(GT) for GT in GTs),
+            dtype=np.intp,
+            count=len(GTs),
+        )
+
+    def count(self, record, groups):
+        """
+        Raw allele & genotype counts (one row per group, one column per
+        COUNTS entry) computed in a single pass over the record's genotypes
+        """
+        n_samples = len(groups.samples)
+        chunk_size = self.sample_chunk_size
+        if chunk_size is None or chunk_size >= n_samples:
+            codes = self.encode(record)
+            table = self.table
+            n_codes = len(table)
+            cell_codes = np.bincount(
+                groups.cells * n_codes + codes, minlength=groups.n_cells * n_codes
+            ).reshape(groups.n_cells, n_codes)
+            return groups.matrix @ (cell_codes @ table)
+
+        # Decode chunk_size samples at a time, summing their counts per cell into
+        # buffers reused for every record, so memory doesn't grow with the number
+        # of samples
+        keys, cell_counts = self._chunk_buffers(groups.n_cells, chunk_size)
+        cell_counts[:] = 0
+        for start in range(0, n_samples, chunk_size):
+            stop = min(start + chunk_size, n_samples)
+            codes = self.encode(record, start, stop)
+            table = self.table
+            n_codes = len(table)
+            chunk_keys = keys[: stop - start]
+            np.multiply(groups.cells[start:stop], n_codes, out=chunk_keys)
+            chunk_keys += codes
+            cell_codes = np.bincount(
+                chunk_keys, minlength=groups.n_cells * n_codes
+            ).reshape(groups.n_cells, n_codes)
+            cell_counts += cell_codes @ table
+        return groups.matrix @ cell_counts
+
+    def _chunk_buffers(self, n_cells, chunk_size):
+        """
+        This thread's (bincount keys, per-cell counts) buffers for chunked
+        counting
+        """
+        buffers = self._buffers
+        if getattr(buffers, 'shape', None) != (n_cells, chunk_size):
+            buffers.shape = (n_cells, chunk_size)
+            buffers.keys = np.empty(chunk_size, dtype=np.intp)
+            buffers.cell_counts = np.empty((n_cells, len(self.COUNTS)), dtype=np.int64)
+        return buffers.keys, buffers.cell_counts
+
+
+def copy_number_counts(record, groups, chunk_size=None):
+    """
+    Reads the CN of every sample once and counts samples per CN for all groups
+    in one grouped pass, chunk_size samples at a time if set. Returns a groups x
+    (max CN + 1) array, or None if CN isn't a non-negative integer field, which
+    calc_allele_freq handles instead.
+    """
+
+    if 'CN' not in record.format or record.header.formats['CN'].type != 'Integer':
+        return None
+
+    # Missing CNs are marked with a sentinel no real CN can take
+    missing = np.iinfo(np.int64).min
+    n_samples = len(groups.samples)
+    if chunk_size is None or chunk_size >= n_samples:
+        chunks = [(0, None)]
+    else:
+        chunks = [
+            (start, min(start + chunk_size, n_samples))
+            for start in range(0, n_samples, chunk_size)
+        ]
+
+    # Count samples per (cell, CN), widening as higher CNs are seen, then sum
+    # cells into groups
+    cell_counts = np.zeros((groups.n_cells, 1), dtype=np.int64)
+    for start, stop in chunks:
+        CNs = sample_values(record, 'CN', start, stop)
+        CNs = np.fromiter(
+            (missing if CN is None else CN for CN in CNs),
+            dtype=np.int64,
+            count=len(CNs),
+        )
+        called = CNs != missing
+        if (CNs[called] < 0).any():
+            return None
+        if not called.any():
+            continue
+        width = int(CNs.max()) + 1
+        if width > cell_counts.shape[1]:
+            cell_counts = np.pad(
+                cell_counts, ((0, 0), (0, width - cell_counts.shape[1]))
+            )
+        width = cell_counts.shape[1]
+        cells = groups.cells[start:stop]
+        cell_counts += np.bincount(
+            cells[called] * width + CNs[called], minlength=groups.n_cells * width
+        ).reshape(groups.n_cells, width)
+    return groups.matrix @ cell_counts
+
+
+def gather_allele_freqs_vectorized(
+    record,
+    groups,
+    encoder,
+    parbt,
+    pops,
+    sex_chroms,
+    stats=None,
+    stats_writer=None,
+):
+    """
+    Equivalent of gather_allele_freqs that decodes each record's genotypes once
+    and computes the counts for all sex & population groups in one pass.
+
+    If optioned, the counts of previously processed samples (stats) are added
+    before computing frequencies, and the combined counts are saved
+    (stats_writer).
+    """
+
+    # Add PAR annotation to record (if optioned)
+    if record.chrom in sex_chroms and len(parbt) > 0:
+        if in_par(record, parbt):
+            rec_in_par = True
+            record.info['PAR'] = True
+        else:
+            rec_in_par = False
+    else:
+        rec_in_par = False
+    hemi_record = record.chrom in sex_chroms and not rec_in_par
+    has_sexes = 'MALE' in groups.sexes or 'FEMALE' in groups.sexes
+
+    if svu.is_biallelic(record):
+        with stage_timer.time('calc_biallelic'):
+            counts = encoder.count(record, groups)
+            row = None
+            if stats is not None:
+                counts, row = stats.add_counts(record, counts)
+            if stats_writer is not None:
+                stats_writer.add(
+                    record,
+                    counts=counts,
+                    stored_batches=() if stats is None else stats.stored_batches(row),
+                )
+            counts = counts.tolist()
+            for prefix, sex, (AN, AC, n_homref, n_het, n_homalt) in zip(
+                groups.prefixes, groups.sexes, counts
+            ):
+                write_biallelic_freqs(
+                    record,
+                    AN,
+                    AC,
+                    n_homref,
+                    n_het,
+                    n_homalt,
+                    prefix=prefix,
+                    hemi=hemi_record and sex == 'MALE',
+                )
+    else:
+        with stage_timer.time('calc_cn'):
+            CN_counts = copy_number_counts(record, groups, encoder.sample_chunk_size)
+            if CN_counts is None and (stats is not None or stats_writer is not None):
+                raise ValueError(
+                    'Sufficient statistics require an Integer FORMAT CN of 0 or '
+                    + 'more, at {0}'.format(stats_key(record))
+                )
+            row = None
+            if stats is not None:
+                CN_counts, row = stats.add_copy_numbers(record, CN_counts)
+            if stats_writer is not None:
+                stats_writer.add(
+                    record,
+                    CN_counts=CN_counts,
+                    stored_batches=() if stats is None else stats.stored_batches(row),
+                )
+            if CN_counts is not None:
+                for prefix, sex, CN_dist in zip(
+                    groups.prefixes, groups.sexes, CN_counts.tolist()
+                ):
+                    # Trim each group's counts to its own max observed CN
+                    while len(CN_dist) > 0 and CN_dist[-1] == 0:
+                        CN_dist.pop()
+                    write_cn_freqs(
+                        record,
+                        sum(CN_dist),
+                        CN_dist,
+                        prefix=prefix,
+                        hemi=hemi_record and sex == 'MALE',
+                    )
+        if CN_counts is None:
+            for prefix, sex, members in zip(
+                groups.prefixes, groups.sexes, groups.members
+            ):
+                calc_allele_freq(
+                    record, members, prefix=prefix, hemi=hemi_record and sex == 'MALE'
+                )
+
+    if not svu.is_biallelic(record):
+        return record
+
+    # Adjust global & per-pop allele frequencies on sex chromosomes, if famfile
+    # provided, from the counts in memory rather than the values just written
+    pop_AFs = {}
+    if hemi_record and has_sexes:
+        with stage_timer.time('update_sex_freqs'):
+            for prefix, adj_an, adj_ac, adj_af in groups.sex_adjusted_freqs(counts):
+                keys = group_info_keys(prefix)
+                record.info[keys['AN']] = adj_an
+                record.info[keys['AC']] = (adj_ac,)
+                record.info[keys['AF']] = (adj_af,)
+                pop_AFs[prefix] = adj_af
+
+    # Get POPMAX AF biallelic sites only
+    if len(pops) > 0:
+        AFs = []
+        for pop in pops:
+            if pop in pop_AFs:
+                AFs.append(pop_AFs[pop])
+            else:
+                AN, AC = counts[groups.index[pop]][:2]
+                AFs.append(round(AC / AN, 6) if AN > 0 else 0)
+        # AFs are stored as float32, which preserves their order
+        record.info['POPMAX_AF'] = max(AFs)
+
+    return record
+
+
+class AlleleFreqAnnotator:
+    """
+    Holds the sample groupings & options needed to annotate records, so that a
+    single object can be handed to worker processes
+    """
+
+    def __init__(
+        self,
+        samples_list,
+        males_set,
+        females_set,
+        parbt,
+        pop_dict,
+        pops,
+        sex_chroms,
+        no_combos=False,
+        vectorized=False,
+        stats=None,
+        sample_chunk_size=None,
+    ):
+        self.samples_list = samples_list
+        self.males_set = males_set
+        self.females_set = females_set
+        self.parbt = parbt
+        self.pop_dict = pop_dict
+        self.pops = pops
+        self.sex_chroms = sex_chroms
+        self.no_combos = no_combos
+        self.vectorized = vectorized
+
+        # Index samples by sex & population once, rather than for every record
+        self.groups = SampleGroups(
+            samples_list, males_set, females_set, pop_dict, pops, no_combos
+        )
+        self.encoder = GenotypeEncoder(sample_chunk_size) if vectorized else None
+
+        # SufficientStats of earlier samples to add to every record's counts
+        self.stats = stats
+        # StatsWriter saving every record's counts, set per process or shard
+        self.stats_writer = None
+
+    def annotate(self, record):
+        """
+        Add allele frequencies for all sex & population groups to a record
+        """
+        if self.vectorized:
+            return gather_allele_freqs_vectorized(
+                record,
+                self.groups,
+                self.encoder,
+                self.parbt,
+                self.pops,
+                self.sex_chroms,
+                self.stats,
+                self.stats_writer,
+            )
+        return gather_allele_freqs(
+            record,
+            self.samples_list,
+            self.males_set,
+            self.females_set,
+            self.parbt,
+            self.pop_dict,
+            self.pops,
+            self.sex_chroms,
+            self.no_combos,
+            self.groups,
+        )
+
+
+def shard_regions(vcf, regions='contig', window_size=10_000_000):
+    """
+    Split an indexed VCF into (contig, start, end) shards, in index order.
+    start & end are None for shards spanning a whole contig. The last window of
+    each contig has no end, so records past the contig's declared length are
+    still annotated.
+    """
+
+    shards = []
+    for contig in vcf.index:
+        length = None
+        if contig in vcf.header.contigs:
+            length = vcf.header.contigs[contig].length
+        if regions == 'window' and length:
+            for start in range(0, length, window_size):
+                end = start + window_size
+                shards.append((contig, start, end if end < length else None))
+        else:
+            shards.append((contig, None, None))
+
+    return shards
+
+
+def info_ids(info_lines):
+    """
+    IDs of the INFO fields declared by a list of ##INFO header lines
+    """
+    return [line.split('ID=', 1)[1].split(',', 1)[0] for line in info_lines]
+
+
+def sidecar_type(info):
+    """
+    Arrow type of the sidecar column for an INFO header record
+    """
+    if info.type == 'Flag':
+        return pa.bool_()
+    value_type = {
+        'Integer': pa.int64(),
+        'Float': pa.float32(),
+        'String': pa.string(),
+    }[info.type]
+    if info.number in (1, 'A'):
+        return value_type
+    return pa.list_(value_type)
+
+
+class FrequencySidecar:
+    """
+    Columnar (Parquet) copy of the computed INFO fields, with one row per record.
+    Rows are buffered and written out one row group at a time, so memory use
+    does not grow with the number of records.
+    """
+
+    def __init__(self, path, header, info_keys, row_group_size=10_000):
+        if pq is None:
+            raise ImportError('pyarrow is required to write a frequency sidecar')
+
+        self.info_keys = list(info_keys)
+        self.numbers = [header.info[key].number for key in self.info_keys]
+        self.has_svtype = 'SVTYPE' in header.info
+        self.row_group_size = row_group_size
+
+        fields = [
+            pa.field('CHROM', pa.string()),
+            pa.field('POS', pa.int64()),
+            pa.field('ID', pa.string()),
+            pa.field('SVTYPE', pa.string()),
+        ]
+        for key in self.info_keys:
+            fields.append(pa.field(key, sidecar_type(header.info[key])))
+        self.schema = pa.schema(fields)
+        self.columns = [[] for _ in fields]
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def add(self, record):
+        chroms, positions, ids, svtypes = self.columns[:4]
+        chroms.append(record.chrom)
+        positions.append(record.pos)
+        ids.append(record.id)
+        svtypes.append(record.info.get('SVTYPE') if self.has_svtype else None)
+
+        info = record.info
+        for column, key, number in zip(self.columns[4:], self.info_keys, self.numbers):
+            value = info.get(key)
+            if number == 0:
+                value = bool(value)
+            elif number == 'A' and value is not None:
+                value = value[0]
+            column.append(value)
+
+        if len(chroms) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.columns[0]) == 0:
+            return
+        self.writer.write_table(
+            pa.Table.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(self.columns, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        self.columns = [[] for _ in self.columns]
+
+    def append_file(self, path):
+        """
+        Copy all row groups of another sidecar with the same schema
+        """
+        self.flush()
+        part = pq.ParquetFile(path)
+        for i in range(part.num_row_groups):
+            self.writer.write_table(part.read_row_group(i))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def stats_key(record):
+    """
+    Key matching a record to its sufficient statistics: the variant ID, or its
+    position if it has none
+    """
+    if record.id is not None:
+        return record.id
+    return '{0}:{1}'.format(record.chrom, record.pos)
+
+
+class SufficientStats:
+    """
+    Sufficient statistics of previously processed samples, loaded from a store
+    written by StatsWriter: raw allele & genotype counts (GenotypeEncoder.COUNTS)
+    of biallelic records and CN histograms of multiallelic ones, per variant &
+    group. These are added to the counts of the samples in the current VCF, so
+    frequencies can be updated for a new batch of samples without re-reading
+    old genotypes.
+
+    Samples are stored in batches, one per run, and each row lists the batches
+    its counts cover. Variants of the current VCF without a row fail unless
+    allow_new is set, in which case they only count the current samples.
+    Stored rows are marked as matched as they are used, so those missing from
+    the current VCF can be reported and carried over to the next store.
+    """
+
+    def __init__(self, path, groups, allow_new=False):
+        if pq is None:
+            raise ImportError('pyarrow is required to read sufficient statistics')
+
+        table = pq.read_table(path)
+        metadata = table.schema.metadata
+        stored_prefixes = json.loads(metadata[b'compute_AFs.groups'])
+        self.samples = json.loads(metadata[b'compute_AFs.samples'])
+        # Stores written before batches were recorded hold a single batch
+        self.batches = json.loads(
+            metadata.get(b'compute_AFs.batches', json.dumps([self.samples]))
+        )
+        self.path = path
+        self.allow_new = allow_new
+
+        overlap = set(self.samples) & set(groups.samples)
+        if len(overlap) > 0:
+            raise ValueError(
+                '{0} sample(s) are already counted in {1}, e.g. {2}'.format(
+                    len(overlap), path, sorted(overlap)[0]
+                )
+            )
+        # Stored groups are stored by INFO prefix (None for all samples)
+        unknown = [p for p in stored_prefixes if p not in groups.index]
+        if len(unknown) > 0:
+            raise ValueError(
+                'Groups in {0} are not computed in this run: {1}. Use the fam & '
+                'pop files of the whole cohort.'.format(
+                    path, ', '.join(p or 'all samples' for p in unknown)
+                )
+            )
+        group_idx = np.array([groups.index[p] for p in stored_prefixes], dtype=np.intp)
+        self.n_groups = len(groups.row_prefixes)
+        self.group_idx = group_idx
+
+        self.keys = table.column('KEY').to_pylist()
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.chroms = table.column('CHROM').combine_chunks()
+        self.positions = table.column('POS').combine_chunks()
+        if 'BATCHES' in table.column_names:
+            self.row_batches = table.column('BATCHES').combine_chunks()
+        else:
+            self.row_batches = None
+
+        # Dense (variant x group x count) array of biallelic counts, in the
+        # current run's group order
+        self.counts = np.zeros(
+            (table.num_rows, self.n_groups, len(GenotypeEncoder.COUNTS)),
+            dtype=np.int64,
+        )
+        counts = table.column('COUNTS').combine_chunks()
+        self.has_counts = np.asarray(counts.is_valid())
+        if self.has_counts.any():
+            values = np.asarray(counts.flatten(), dtype=np.int64)
+            self.counts[np.ix_(np.flatnonzero(self.has_counts), group_idx)] = (
+                values.reshape(self.has_counts.sum(), len(group_idx), -1)
+            )
+        self.cn_counts = table.column('CN_COUNTS').combine_chunks()
+
+        # Stored rows used by this process, and keys of the current VCF's
+        # variants without a stored row
+        self.matched = np.zeros(table.num_rows, dtype=bool)
+        self.new_keys = []
+
+    def find_row(self, record, biallelic):
+        """
+        Index of a record's stored row, or None for a new variant. The row must
+        hold counts of the same kind as the record.
+        """
+        key = stats_key(record)
+        row = self.rows.get(key)
+        if row is not None:
+            if biallelic:
+                stored = self.has_counts[row]
+            else:
+                stored = self.cn_counts[row].is_valid
+            if not stored:
+                row = None
+        if row is None:
+            if not self.allow_new:
+                raise ValueError(
+                    '{0} has no {1} counts in {2}. Use --stats-allow-new to '
+                    'count only the samples in this VCF for such variants.'.format(
+                        key, 'biallelic' if biallelic else 'CN', self.path
+                    )
+                )
+            self.new_keys.append(key)
+            return None
+        self.matched[row] = True
+        return row
+
+    def stored_batches(self, row):
+        """
+        Indexes of the stored batches counted in a row
+        """
+        if row is None:
+            return []
+        if self.row_batches is None:
+            return list(range(len(self.batches)))
+        return self.row_batches[row].as_py()
+
+    def add_counts(self, record, counts):
+        """
+        Allele & genotype counts per group of a biallelic record, including
+        the stored samples. Returns the counts and the stored row used.
+        """
+        row = self.find_row(record, biallelic=True)
+        if row is None:
+            return counts, None
+        return counts + self.counts[row], row
+
+    def stored_copy_numbers(self, row):
+        """
+        Stored CN histograms of a row, per group of the current run
+        """
+        dists = [[] for _ in range(self.n_groups)]
+        for i, dist in zip(self.group_idx, self.cn_counts[row].as_py()):
+            dists[i] = dist
+        return dists
+
+    def add_copy_numbers(self, record, CN_counts):
+        """
+        CN histograms per group of a multiallelic record, including the stored
+        samples. Returns the histograms and the stored row used.
+        """
+        row = self.find_row(record, biallelic=False)
+        if row is None:
+            return CN_counts, None
+        stored = self.stored_copy_numbers(row)
+        width = max([CN_counts.shape[1]] + [len(dist) for dist in stored])
+        merged = np.zeros((self.n_groups, width), dtype=np.int64)
+        merged[:, : CN_counts.shape[1]] = CN_counts
+        for i, dist in enumerate(stored):
+            merged[i, : len(dist)] += dist
+        return merged, row
+
+    def merge_matches(self, matched_rows, new_keys):
+        """
+        Add the stored rows used & new variants found by another process
+        """
+        self.matched[matched_rows] = True
+        self.new_keys.extend(new_keys)
+
+    def copy_unmatched(self, stats_writer):
+        """
+        Write the stored rows of variants missing from the current VCF to
+        stats_writer unchanged, and report them & any new variants
+        """
+        if len(self.new_keys) > 0:
+            print(
+                '{0} variant(s) have no counts in {1} and only count the samples '
+                'in this VCF, e.g. {2}'.format(
+                    len(self.new_keys), self.path, self.new_keys[0]
+                ),
+                file=sys.stderr,
+            )
+        unmatched = np.flatnonzero(~self.matched)
+        if len(unmatched) == 0:
+            return
+        print(
+            '{0} variant(s) in {1} are not in this VCF{2}, e.g. {3}'.format(
+                len(unmatched),
+                self.path,
+                '; copying their counts to the new store'
+                if stats_writer is not None
+                else '',
+                self.keys[unmatched[0]],
+            ),
+            file=sys.stderr,
+        )
+        if stats_writer is None:
+            return
+        for row in unmatched.tolist():
+            counts = None
+            CN_counts = None
+            if self.has_counts[row]:
+                counts = self.counts[row]
+            if self.cn_counts[row].is_valid:
+                CN_counts = self.stored_copy_numbers(row)
+            stats_writer.add_row(
+                self.keys[row],
+                self.chroms[row].as_py(),
+                self.positions[row].as_py(),
+                counts,
+                CN_counts,
+                self.stored_batches(row),
+            )
+
+
+class StatsWriter:
+    """
+    Writes the sufficient statistics behind each record's frequencies to a
+    Parquet store, one row per variant, for SufficientStats to fold a later
+    batch of samples into. Rows are buffered and written one row group at a
+    time; add() may be called from several compute threads.
+
+    batches lists the samples of every run counted in the store, the current
+    run last. Each row records which of them its counts cover.
+    """
+
+    def __init__(self, path, groups, batches, row_group_size=10_000):
+        if pq is None:
+            raise ImportError('pyarrow is required to write sufficient statistics')
+
+        self.row_group_size = row_group_size
+        self.batch = len(batches) - 1
+        self.schema = pa.schema(
+            [
+                pa.field('KEY', pa.string()),
+                pa.field('CHROM', pa.string()),
+                pa.field('POS', pa.int64()),
+                # Flattened groups x GenotypeEncoder.COUNTS, biallelic records only
+                pa.field('COUNTS', pa.list_(pa.int64())),
+                # Per group counts from CN=0, multiallelic records only
+                pa.field('CN_COUNTS', pa.list_(pa.list_(pa.int64()))),
+                # Indexes of the batches whose samples are counted
+                pa.field('BATCHES', pa.list_(pa.int32())),
+            ],
+            metadata={
+                'compute_AFs.groups': json.dumps(groups.row_prefixes),
+                'compute_AFs.counts': json.dumps(GenotypeEncoder.COUNTS),
+                'compute_AFs.samples': json.dumps(
+                    [sample for batch in batches for sample in batch]
+                ),
+                'compute_AFs.batches': json.dumps([list(batch) for batch in batches]),
+            },
+        )
+        self.columns = [[] for _ in self.schema]
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self._lock = threading.Lock()
+
+    def add(self, record, counts=None, CN_counts=None, stored_batches=()):
+        """
+        Save a record's counts, covering the current batch & the stored
+        batches they include
+        """
+        self.add_row(
+            stats_key(record),
+            record.chrom,
+            record.pos,
+            counts,
+            CN_counts,
+            list(stored_batches) + [self.batch],
+        )
+
+    def add_row(self, key, chrom, pos, counts, CN_counts, batches):
+        if CN_counts is not None:
+            CN_counts = [
+                np.trim_zeros(np.asarray(dist, dtype=np.int64), 'b').tolist()
+                for dist in CN_counts
+            ]
+        if counts is not None:
+            counts = np.asarray(counts).ravel().tolist()
+        row = (key, chrom, pos, counts, CN_counts, batches)
+        with self._lock:
+            for column, value in zip(self.columns, row):
+                column.append(value)
+            if len(self.columns[0]) >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        if len(self.columns[0]) == 0:
+            return
+        self.writer.write_table(
+            pa.Table.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(self.columns, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        self.columns = [[] for _ in self.columns]
+
+    def append_file(self, path):
+        """
+        Copy all row groups of another store with the same schema
+        """
+        self.flush()
+        part = pq.ParquetFile(path)
+        for i in range(part.num_row_groups):
+            self.writer.write_table(
+                part.read_row_group(i).replace_schema_metadata(self.schema.metadata)
+            )
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def sites_only_header(header):
+    """
+    Copy of a VCF header without its samples
+    """
+    sites_header = pysam.VariantHeader()
+    for header_record in header.records:
+        sites_header.add_record(header_record)
+    return sites_header
+
+
+class SitesOnlyWriter:
+    """
+    Writes annotated records with their samples dropped, so per-sample FORMAT
+    fields are never re-encoded.
+    INFO fields are written in their original order, except END which always
+    comes first.
+    """
+
+    def __init__(self, path, header):
+        self.header = sites_only_header(header)
+        if path in '- stdout'.split():
+            self.fout = pysam.VariantFile(sys.stdout, 'w', header=self.header)
+        else:
+            self.fout = pysam.VariantFile(path, 'w', header=self.header)
+
+    def write(self, record):
+        site = self.header.new_record(
+            contig=record.chrom,
+            start=record.start,
+            stop=record.stop,
+            alleles=record.alleles,
+            id=record.id,
+            qual=record.qual,
+            filter=list(record.filter),
+        )
+        for key, value in record.info.items():
+            site.info[key] = value
+        self.fout.write(site)
+
+    def close(self):
+        self.fout.close()
+
+
+def format_annotation_value(value, number):
+    """
+    Format an INFO value as text for an annotation table
+    """
+    if number == 0:
+        return '1' if value else '0'
+    if value is None:
+        return '.'
+    if not isinstance(value, tuple):
+        value = (value,)
+    return ','.join(
+        # Shortest text which round-trips to the same 32-bit VCF float
+        str(np.float32(v)) if isinstance(v, float) else str(v)
+        for v in value
+    )
+
+
+class AnnotationTableWriter:
+    """
+    Writes the computed INFO fields as a tab-delimited table (CHROM, POS, ID,
+    REF, ALT and one column per INFO field) which can be merged back into the
+    input VCF with bcftools annotate, without rewriting any genotypes.
+    SV records often share a POS & symbolic ALT such as <DEL>, so rows are
+    matched on their ID too.
+    """
+
+    def __init__(self, fout, header, info_keys, write_header=True):
+        self.fout = fout
+        self.info_keys = list(info_keys)
+        self.numbers = [header.info[key].number for key in self.info_keys]
+        if write_header:
+            self.fout.write(self.header_line(self.info_keys).encode())
+
+    @staticmethod
+    def header_line(info_keys):
+        return '#' + '\t'.join(['CHROM', 'POS', 'ID', 'REF', 'ALT'] + info_keys) + '\n'
+
+    @staticmethod
+    def annotate_columns(info_keys):
+        """
+        Columns for bcftools annotate -c, matching records on ID as well as
+        position & alleles
+        """
+        return ','.join(['CHROM', 'POS', '~ID', 'REF', 'ALT'] + info_keys)
+
+    def write(self, record):
+        info = record.info
+        fields = [
+            record.chrom,
+            str(record.pos),
+            record.id or '.',
+            record.ref,
+            ','.join(record.alts or ('.',)),
+        ]
+        for key, number in zip(self.info_keys, self.numbers):
+            fields.append(format_annotation_value(info.get(key), number))
+        self.fout.write(('\t'.join(fields) + '\n').encode())
+
+    def close(self):
+        if self.fout is not sys.stdout.buffer:
+            self.fout.close()
+
+
+def finish_annotation_table(path, info_lines):
+    """
+    Index a bgzipped annotation table and write the INFO header lines that
+    bcftools annotate needs alongside it, e.g.
+        bcftools annotate -a <path> -h <path>.hdr \\
+            -c CHROM,POS,~ID,REF,ALT,<INFO columns of the table header> in.vcf.gz
+    The .hdr also records the full -c value in a compute_AFs_annotate_columns
+    line.
+    """
+    if path in '- stdout'.split():
+        return
+    if path.endswith(('.gz', '.bgz')):
+        pysam.tabix_index(
+            path, seq_col=0, start_col=1, end_col=1, meta_char='#', force=True
+        )
+    with open(path + '.hdr', 'w') as hdr:
+        for line in info_lines:
+            hdr.write(line + '\n')
+        hdr.write(
+            '##compute_AFs_annotate_columns={0}\n'.format(
+                AnnotationTableWriter.annotate_columns(info_ids(info_lines))
+            )
+        )
+
+
+def open_record_output(path, header, info_lines, output_mode, write_header=True):
+    """
+    Open the writer for annotated records for an output mode: the full VCF,
+    a sites-only VCF, or an INFO annotation table
+    """
+    if output_mode == 'sites':
+        return SitesOnlyWriter(path, header)
+    if output_mode == 'annotation':
+        return AnnotationTableWriter(
+            open_text_output(path), header, info_ids(info_lines), write_header
+        )
+    if path in '- stdout'.split():
+        return pysam.VariantFile(sys.stdout, 'w', header=header)
+    return pysam.VariantFile(path, 'w', header=header)
+
+
+def output_header_text(header, info_lines, output_mode):
+    """
+    Header written once to the output when concatenating shards
+    """
+    if output_mode == 'sites':
+        return str(sites_only_header(header))
+    if output_mode == 'annotation':
+        return AnnotationTableWriter.header_line(info_ids(info_lines))
+    return str(header)
+
+
+class RecordWriter:
+    """
+    Writes annotated records to the output VCF, and to the frequency sidecar if
+    one was requested
+    """
+
+    def __init__(self, fout, sidecar=None, progress=None):
+        self.fout = fout
+        self.sidecar = sidecar
+        self.progress = progress
+
+    def write(self, record):
+        with stage_timer.time('write'):
+            self.fout.write(record)
+            if self.sidecar is not None:
+                self.sidecar.add(record)
+        if self.progress is not None:
+            self.progress.update(record)
+
+    def close(self):
+        self.fout.close()
+        if self.sidecar is not None:
+            self.sidecar.close()
+        if self.progress is not None:
+            self.progress.log()
+
+
+# Per-process state of shard workers, set by init_shard_worker
+_shard_worker = {}
+
+
+def init_shard_worker(
+    vcf_path,
+    info_lines,
+    annotator,
+    tmpdir,
+    sidecar_row_group_size=None,
+    output_mode='vcf',
+    profile=False,
+    progress_interval=None,
+    stats_batches=None,
+):
+    stage_timer.enabled = profile
+    _shard_worker['stats_batches'] = stats_batches
+    _shard_worker['progress_interval'] = progress_interval
+    _shard_worker['vcf_path'] = vcf_path
+    _shard_worker['output_mode'] = output_mode
+    _shard_worker['info_lines'] = info_lines
+    _shard_worker['annotator'] = annotator
+    _shard_worker['tmpdir'] = tmpdir
+    _shard_worker['sidecar_row_group_size'] = sidecar_row_group_size
+
+
+def annotate_shard(shard):
+    """
+    Annotate all records starting within a shard, writing them to an
+    uncompressed temporary output (and sidecar & sufficient statistics, if
+    optioned). Returns the paths of the temporary files, the stored sufficient
+    statistics rows used & new variants found, and the shard's stage times.
+    """
+
+    i, (contig, start, end) = shard
+    stage_timer.reset()
+    vcf = pysam.VariantFile(_shard_worker['vcf_path'])
+    for line in _shard_worker['info_lines']:
+        vcf.header.add_line(line)
+
+    shard_path = os.path.join(_shard_worker['tmpdir'], 'shard_%06d.vcf' % i)
+    sidecar_path = None
+    sidecar = None
+    if _shard_worker['sidecar_row_group_size'] is not None:
+        sidecar_path = os.path.join(_shard_worker['tmpdir'], 'shard_%06d.parquet' % i)
+        sidecar = FrequencySidecar(
+            sidecar_path,
+            vcf.header,
+            info_ids(_shard_worker['info_lines']),
+            _shard_worker['sidecar_row_group_size'],
+        )
+    progress = None
+    if _shard_worker['progress_interval'] is not None:
+        label = 'shard {0} ({1})'.format(
+            i,
+            contig
+            if start is None
+            else '{0}:{1}-{2}'.format(contig, start + 1, end or ''),
+        )
+        progress = ProgressLogger(_shard_worker['progress_interval'], label)
+    fout = RecordWriter(
+        open_record_output(
+            shard_path,
+            vcf.header,
+            _shard_worker['info_lines'],
+            _shard_worker['output_mode'],
+            write_header=False,
+        ),
+        sidecar,
+        progress,
+    )
+    annotator = _shard_worker['annotator']
+    if annotator.stats is not None:
+        # Workers handle many shards, only report the matches of this one
+        annotator.stats.matched[:] = False
+        annotator.stats.new_keys = []
+    stats_path = None
+    if _shard_worker['stats_batches'] is not None:
+        stats_path = os.path.join(_shard_worker['tmpdir'], 'shard_%06d.stats' % i)
+        annotator.stats_writer = StatsWriter(
+            stats_path, annotator.groups, _shard_worker['stats_batches']
+        )
+    for r in vcf.fetch(contig, start, end):
+        # Records spanning a window boundary are fetched by both windows, only
+        # keep them in the window they start in
+        if start is not None and not (
+            start <= r.start and (end is None or r.start < end)
+        ):
+            continue
+        fout.write(annotator.annotate(r))
+    fout.close()
+    vcf.close()
+    if annotator.stats_writer is not None:
+        annotator.stats_writer.close()
+        annotator.stats_writer = None
+    stats_matches = None
+    if annotator.stats is not None:
+        stats_matches = (
+            np.flatnonzero(annotator.stats.matched),
+            annotator.stats.new_keys,
+        )
+
+    return shard_path, sidecar_path, stats_path, stats_matches, stage_timer.snapshot()
+
+
+def open_text_output(path):
+    """
+    Open a binary stream to write VCF or table text to, BGZF-compressed for
+    .gz/.bgz
+    """
+
+    if path in '- stdout'.split():
+        return sys.stdout.buffer
+    if path.endswith('.bcf'):
+        raise ValueError('Text output must be VCF or bgzipped VCF, not BCF')
+    if path.endswith(('.gz', '.bgz')):
+        return pysam.BGZFile(path, 'wb')
+    return open(path, 'wb')
+
+
+def append_vcf_body(path, out):
+    """
+    Copy all records of a VCF or table to an output stream, skipping the header
+    """
+
+    with open(path, 'rb') as vcf_in:
+        for line in vcf_in:
+            if not line.startswith(b'#'):
+                out.write(line)
+                break
+        shutil.copyfileobj(vcf_in, out)
+
+
+def run_sharded(
+    vcf_path,
+    header,
+    info_lines,
+    annotator,
+    fout_path,
+    threads,
+    regions,
+    window_size,
+    sidecar_path=None,
+    sidecar_row_group_size=10_000,
+    output_mode='vcf',
+    progress_interval=None,
+    stats_path=None,
+    stats_batches=None,
+):
+    """
+    Annotate an indexed VCF in a pool of worker processes, one shard at a time,
+    then write the shards to the output in their original order
+    """
+
+    vcf = pysam.VariantFile(vcf_path)
+    if vcf.index is None:
+        raise ValueError('--threads > 1 requires an indexed input VCF')
+    shards = shard_regions(vcf, regions, window_size)
+    vcf.close()
+
+    tmpdir = tempfile.mkdtemp(prefix='compute_AFs.')
+    fout = open_text_output(fout_path)
+    sidecar = None
+    if sidecar_path is not None:
+        sidecar = FrequencySidecar(
+            sidecar_path, header, info_ids(info_lines), sidecar_row_group_size
+        )
+    stats_writer = None
+    if stats_path is not None:
+        stats_writer = StatsWriter(stats_path, annotator.groups, stats_batches)
+    try:
+        fout.write(output_header_text(header, info_lines, output_mode).encode())
+        with multiprocessing.Pool(
+            threads,
+            initializer=init_shard_worker,
+            initargs=(
+                vcf_path,
+                info_lines,
+                annotator,
+                tmpdir,
+                sidecar_row_group_size if sidecar is not None else None,
+                output_mode,
+                stage_timer.enabled,
+                progress_interval,
+                stats_batches if stats_writer is not None else None,
+            ),
+        ) as pool:
+            # imap yields shards in order, so each can be appended and removed
+            # as soon as it and all shards before it are done
+            for (
+                shard_path,
+                shard_sidecar,
+                shard_stats,
+                shard_matches,
+                shard_stages,
+            ) in pool.imap(annotate_shard, enumerate(shards)):
+                stage_timer.merge(shard_stages)
+                if shard_matches is not None:
+                    annotator.stats.merge_matches(*shard_matches)
+                append_vcf_body(shard_path, fout)
+                os.remove(shard_path)
+                if shard_sidecar is not None:
+                    sidecar.append_file(shard_sidecar)
+                    os.remove(shard_sidecar)
+                if shard_stats is not None:
+                    stats_writer.append_file(shard_stats)
+                    os.remove(shard_stats)
+        if annotator.stats is not None:
+            annotator.stats.copy_unmatched(stats_writer)
+    finally:
+        if fout is not sys.stdout.buffer:
+            fout.close()
+        if sidecar is not None:
+            sidecar.close()
+        if stats_writer is not None:
+            stats_writer.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if output_mode == 'annotation':
+        finish_annotation_table(fout_path, info_lines)
+
+
+def iter_records(vcf):
+    """
+    Iterate over all records of a VCF. Indexed inputs are fetched as before,
+    streams such as stdin are read sequentially.
+    """
+
+    if vcf.index is not None:
+        return vcf.fetch()
+    return iter(vcf)
+
+
+def run_pipelined(records, fout, annotator, workers, batch_size, queue_depth):
+    """
+    Annotate a stream of records with a reader thread, a pool of compute threads
+    and an ordered writer, connected by bounded queues.
+
+    Records are handed between stages in batches. At most queue_depth + workers
+    batches are held in memory at any time, however large the input.
+    """
+
+    in_queue = queue.Queue(maxsize=queue_depth)
+    out_queue = queue.Queue()
+    # Counts batches that have been read but not yet written, including those
+    # finished out of order and waiting on an earlier batch
+    in_flight = threading.BoundedSemaphore(queue_depth + workers)
+    reader_errors = []
+
+    def read():
+        try:
+            batch = []
+            n_batches = 0
+            for r in records:
+                batch.append(r)
+                if len(batch) == batch_size:
+                    in_flight.acquire()
+                    in_queue.put((n_batches, batch))
+                    n_batches += 1
+                    batch = []
+            if batch:
+                in_flight.acquire()
+                in_queue.put((n_batches, batch))
+        except Exception as e:
+            reader_errors.append(e)
+        finally:
+            for _ in range(workers):
+                in_queue.put(None)
+
+    def compute():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                out_queue.put(None)
+                return
+            i, batch = item
+            try:
+                for r in batch:
+                    annotator.annotate(r)
+            except Exception as e:
+                out_queue.put((i, e))
+            else:
+                out_queue.put((i, batch))
+
+    threads = [threading.Thread(target=read, daemon=True)]
+    threads += [threading.Thread(target=compute, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # Write batches in input order as they complete
+    pending = {}
+    next_batch = 0
+    workers_done = 0
+    while workers_done < workers:
+        item = out_queue.get()
+        if item is None:
+            workers_done += 1
+            continue
+        i, batch = item
+        if isinstance(batch, Exception):
+            raise batch
+        pending[i] = batch
+        while next_batch in pending:
+            for r in pending.pop(next_batch):
+                fout.write(r)
+            next_batch += 1
+            in_flight.release()
+
+    if reader_errors:
+        raise reader_errors[0]
+
+
+# Per-group INFO fields as (metric, Number, Type, Description). In descriptions,
+# {label} is the group name plus a space (empty for all samples) and {suffix} is
+# the group's INFO key suffix
+# fmt: off
+GROUP_FIELDS = [
+    ('AN', '1', 'Integer', 'Total number of {label}alleles genotyped (biallelic sites only).'),
+    ('AC', 'A', 'Integer', 'Number of non-reference {label}alleles observed (biallelic sites only).'),
+    ('AF', 'A', 'Float', '{label}allele frequency (biallelic sites only).'),
+    ('N_BI_GENOS', '1', 'Integer', 'Total number of {label}samples with complete genotypes (biallelic sites only).'),
+    ('N_HOMREF', '1', 'Integer', 'Number of {label}samples with homozygous reference genotypes (biallelic sites only).'),
+    ('N_HET', '1', 'Integer', 'Number of {label}samples with heterozygous genotypes (biallelic sites only).'),
+    ('N_HOMALT', '1', 'Integer', 'Number of {label}samples with homozygous alternate genotypes (biallelic sites only).'),
+    ('FREQ_HOMREF', '1', 'Float', '{label}homozygous reference genotype frequency (biallelic sites only).'),
+    ('FREQ_HET', '1', 'Float', '{label}heterozygous genotype frequency (biallelic sites only).'),
+    ('FREQ_HOMALT', '1', 'Float', '{label}homozygous alternate genotype frequency (biallelic sites only).'),
+    ('CN_NUMBER', '1', 'Integer', 'Total number of {label}samples with estimated copy numbers (multiallelic CNVs only).'),
+    ('CN_COUNT', '.', 'Integer', 'Number of {label}samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).'),
+    ('CN_STATUS', '.', 'Integer', 'Copy states corresponding to CN_COUNT{suffix}, CN_FREQ{suffix}: 0,1,...,maximum observed copy state (multiallelic CNVs only).'),
+    ('CN_FREQ', '.', 'Float', 'Frequency of {label}samples observed at each copy state, starting from CN=0 (multiallelic CNVs only).'),
+    ('CN_NONREF_COUNT', '1', 'Integer', 'Number of {label}samples with non-reference copy states (multiallelic CNVs only).'),
+    ('CN_NONREF_FREQ', '1', 'Float', 'Frequency of {label}samples with non-reference copy states (multiallelic CNVs only).'),
+]
+# fmt: on
+
+# Additional fields of male groups, which are hemizygous on sex chromosomes
+# fmt: off
+HEMI_FIELDS = [
+    ('N_HEMIREF', '1', 'Integer', 'Number of {label}samples with hemizygous reference genotypes (biallelic sites only).'),
+    ('N_HEMIALT', '1', 'Integer', 'Number of {label}samples with hemizygous alternate genotypes (biallelic sites only).'),
+    ('FREQ_HEMIREF', '1', 'Float', '{label}hemizygous reference genotype frequency (biallelic sites only).'),
+    ('FREQ_HEMIALT', '1', 'Float', '{label}hemizygous alternate genotype frequency (biallelic sites only).'),
+]
+# fmt: on
+
+PAR_HEADER = '##INFO=<ID=PAR,Number=0,Type=Flag,Description="Variant overlaps pseudoautosomal region.">'
+POPMAX_HEADER = '##INFO=<ID=POPMAX_AF,Number=1,Type=Float,Description="Maximum allele frequency across any population (biallelic sites only).">'
+
+
+@functools.lru_cache(maxsize=None)
+def group_info_keys(prefix=None):
+    """
+    INFO key of every per-group metric for the group with this prefix (None for
+    all samples), built once per group rather than for every record
+    """
+    suffix = '_' + prefix if prefix else ''
+    return {metric: metric + suffix for metric, _, _, _ in GROUP_FIELDS + HEMI_FIELDS}
+
+
+class InfoSchema:
+    """
+    Every (metric, group) INFO field computed for the given sexes & populations,
+    and its header line. INFO keys come from group_info_keys, as used by the
+    functions writing each record, so the header and records always agree.
+    """
+
+    def __init__(self, sexes, pops, has_par=False, no_combos=False):
+        # (INFO prefix, description label, hemizygous) of every group, in
+        # header order
+        self.groups = [(None, None, False)]
+        for sex in sexes:
+            self.groups.append((sex, sex, sex == 'MALE'))
+        for pop in pops:
+            self.groups.append((pop, pop, False))
+            if not no_combos:
+                for sex in sexes:
+                    self.groups.append(
+                        ('_'.join((pop, sex)), ' '.join((pop, sex)), sex == 'MALE')
+                    )
+
+        self.header_lines = []
+        for prefix, label, hemi in self.groups:
+            if len(pops) > 0 and prefix == pops[0]:
+                self.header_lines.append(POPMAX_HEADER)
+            self.header_lines += self.group_header_lines(prefix, label, hemi)
+            if prefix == 'MALE' and has_par:
+                self.header_lines.append(PAR_HEADER)
+
+    @staticmethod
+    def group_header_lines(prefix, label, hemi):
+        """
+        Header lines of all INFO fields of one group
+        """
+        keys = group_info_keys(prefix)
+        suffix = '_' + prefix if prefix else ''
+        lines = []
+        for metric, number, type_, description in GROUP_FIELDS + (
+            HEMI_FIELDS if hemi else []
+        ):
+            if label:
+                description = description.format(label=label + ' ', suffix=suffix)
+            else:
+                description = description.format(label='', suffix=suffix)
+                description = description[0].upper() + description[1:]
+            lines.append(
+                '##INFO=<ID={0},Number={1},Type={2},Description="{3}">'.format(
+                    keys[metric], number, type_, description
+                )
+            )
+        return lines
+
+    @property
+    def keys(self):
+        """
+        INFO keys of every group, by prefix & metric
+        """
+        return {prefix: group_info_keys(prefix) for prefix, _, _ in self.groups}
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line options, from sys.argv unless argv is given
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('vcf', help='Input vcf. Also accepts "stdin" and "-".')
+    parser.add_argument(
+        '-p',
+        '--popfile',
+        help='Two-column file of samples & '
+        + 'their population assignments. A "." denotes no assignment.',
+        default=None,
+    )
+    parser.add_argument(
+        '-f',
+        '--famfile',
+        help='Input .fam file (used for sex-specific AFs).',
+        default=None,
+    )
+    parser.add_argument(
+        '--no-combos',
+        help='Do not compute combinations of populations ' + 'and sexes.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--allosomes-list',
+        help='TSV of sex chromosomes (used for ' + 'sex-specific AFs).',
+        default=None,
+    )
+    parser.add_argument(
+        '--par',
+        help='BED file of pseudoautosomal regions (used ' + 'for sex-specific AFs).',
+        default=None,
+    )
+    parser.add_argument(
+        '--vectorized',
+        help="Decode each record's genotypes once and compute frequencies for "
+        + 'all sex & population groups in a single NumPy pass.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--threads',
+        help='Number of worker processes. Values above 1 split an indexed input '
+        + 'VCF into shards (see --regions) which are processed in parallel.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--regions',
+        help='How to shard the input when --threads > 1: one shard per contig, '
+        + 'or fixed-size genomic windows of --window-size bp.',
+        choices=['contig', 'window'],
+        default='contig',
+    )
+    parser.add_argument(
+        '--window-size',
+        help='Shard size in bp for --regions window.',
+        type=int,
+        default=10_000_000,
+    )
+    parser.add_argument(
+        '--pipeline',
+        help='Stream records through separate read, compute & write threads '
+        + '(with --threads compute threads). Used automatically when --threads > 1 '
+        + 'and the input cannot be region-sharded, e.g. stdin.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--batch-size',
+        help='Number of records per batch in --pipeline mode.',
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        '--queue-depth',
+        help='Maximum number of batches queued between pipeline stages.',
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        '--sidecar',
+        help='Also write all computed INFO fields to this Parquet file, one row '
+        + 'per record (CHROM, POS, ID, SVTYPE) and one column per INFO field.',
+        default=None,
+    )
+    parser.add_argument(
+        '--sidecar-row-group-size',
+        help='Number of records buffered per Parquet row group of the sidecar.',
+        type=int,
+        default=10_000,
+    )
+    parser.add_argument(
+        '--sites-only',
+        '--info-only',
+        help='Write the output VCF without samples, so per-sample FORMAT fields '
+        + 'are not re-encoded.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--annotation-tsv',
+        help='Instead of a VCF, write only the computed INFO fields to fout as a '
+        + 'tab-delimited table (bgzipped & tabix-indexed for .gz paths), plus a '
+        + 'fout.hdr file of INFO header lines, for use with bcftools annotate '
+        + '-c CHROM,POS,~ID,REF,ALT,<INFO columns>. Rows are matched on ID as '
+        + 'well, as SV records often share a POS & symbolic ALT.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--profile',
+        help='Time each annotation stage (in_par, calc_allele_freq for biallelic '
+        + '& CN records, update_sex_freqs, write) and log a summary to stderr.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument(
+        '--profile-json',
+        help='Write the --profile summary to this JSON file instead of stderr. '
+        + 'Implies --profile.',
+        default=None,
+    )
+    parser.add_argument(
+        '--progress-interval',
+        help='Log records written, records/sec & the current position to stderr '
+        + 'every this many seconds (per shard with --threads > 1).',
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        '--sample-chunk-size',
+        help='Decode genotypes & copy numbers this many samples at a time, '
+        + 'accumulating counts into reused buffers, so memory per record does '
+        + 'not grow with the number of samples. Implies --vectorized.',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--stats-out',
+        help="Save the allele, genotype & CN counts behind every record's "
+        + 'frequencies, per group, to this Parquet store. Implies --vectorized.',
+        default=None,
+    )
+    parser.add_argument(
+        '--stats-in',
+        help='Store written by --stats-out for an earlier batch of samples. Its '
+        + 'counts are added to those of the samples in the input VCF, matching '
+        + 'variants by ID, so frequencies cover both batches without re-reading '
+        + 'the earlier genotypes. Variants missing from the store fail unless '
+        + '--stats-allow-new is set; stored variants missing from the input VCF '
+        + 'are copied to --stats-out unchanged. Implies --vectorized.',
+        default=None,
+    )
+    parser.add_argument(
+        '--stats-allow-new',
+        help='With --stats-in, count only the samples in the input VCF for '
+        + 'variants without stored counts rather than failing. The number of '
+        + 'such variants is reported, and --stats-out records which batches of '
+        + 'samples each variant covers.',
+        action='store_true',
+        default=False,
+    )
+    parser.add_argument('fout', help='Output vcf. Also accepts "stdout" and "-".')
+    return parser.parse_args(argv)
+
+
+def setup_annotator(args, vcf):
+    """
+    Read the sexes, populations, sex chromosomes & PAR regions optioned in args,
+    add the INFO fields to be computed to the VCF's header, and build the
+    AlleleFreqAnnotator. Returns the annotator and the INFO header lines added.
+    """
+
+    # Get list of all samples in vcf
+    samples_list = list(vcf.header.samples)
+
+    # Get lists of males and females
+    parbt = ParIndex()
+    if args.famfile is not None:
+        famfile = [line.rstrip('\n') for line in open(args.famfile)]
+        males_set = set(
+            [line.split('\t')[1] for line in famfile if line.split('\t')[4] == '1']
+        )
+        males_set = set(s for s in samples_list if s in males_set)
+        females_set = set(
+            [line.split('\t')[1] for line in famfile if line.split('\t')[4] == '2']
+        )
+        females_set = set(s for s in samples_list if s in females_set)
+        sexes = 'MALE FEMALE'.split()
+        if args.par is not None:
+            parbt = ParIndex.from_bed(args.par)
+
+    else:
+        males_set = set()
+        females_set = set()
+        sexes = list()
+
+    # Get dictionary of populations
+    if args.popfile is not None:
+        popfile = [line.rstrip('\n') for line in open(args.popfile)]
+        pop_dict = create_pop_dict(popfile)
+        pops = list(set(pop_dict.values()))
+        pops = sorted([p for p in pops if p != '.'])
+    else:
+        pop_dict = {}
+        pops = []
+
+    # Get list of sex chromosomes, if optioned
+    if args.allosomes_list is not None:
+        sex_chroms = [l.split('\t')[0] for l in open(args.allosomes_list).readlines()]
+    else:
+        sex_chroms = 'X Y chrX chrY'.split()
+
+    # Add relevant fields to header
+    INFO_ADD = InfoSchema(sexes, pops, len(parbt) > 0, args.no_combos).header_lines
+    for line in INFO_ADD:
+        vcf.header.add_line(line)
+
+    annotator = AlleleFreqAnnotator(
+        samples_list,
+        males_set,
+        females_set,
+        parbt,
+        pop_dict,
+        pops,
+        sex_chroms,
+        args.no_combos,
+        args.vectorized
+        or args.stats_in is not None
+        or args.stats_out is not None
+        or args.sample_chunk_size is not None,
+        sample_chunk_size=args.sample_chunk_size,
+    )
+    return annotator, INFO_ADD
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_time = time.perf_counter()
+    stage_timer.enabled = args.profile or args.profile_json is not None
+    if args.annotation_tsv:
+        output_mode = 'annotation'
+    elif args.sites_only:
+        output_mode = 'sites'
+    else:
+        output_mode = 'vcf'
+
+    # Open connections to input VCF
+    if args.vcf in '- stdin'.split():
+        vcf = pysam.VariantFile(sys.stdin)
+    else:
+        vcf = pysam.VariantFile(args.vcf)
+
+    annotator, INFO_ADD = setup_annotator(args, vcf)
+    samples_list = list(vcf.header.samples)
+    stats_batches = [samples_list]
+    if args.stats_in is not None:
+        annotator.stats = SufficientStats(
+            args.stats_in, annotator.groups, args.stats_allow_new
+        )
+        stats_batches = annotator.stats.batches + [samples_list]
+    if len(annotator.groups.empty_groups) > 0:
+        print(
+            'No samples in group(s): ' + ', '.join(annotator.groups.empty_groups),
+            file=sys.stderr,
+        )
+
+    use_pipeline = args.pipeline or (
+        args.threads > 1 and (args.vcf in '- stdin'.split() or vcf.index is None)
+    )
+    if args.threads > 1 and not use_pipeline:
+        run_sharded(
+            args.vcf,
+            vcf.header,
+            INFO_ADD,
+            annotator,
+            args.fout,
+            args.threads,
+            args.regions,
+            args.window_size,
+            args.sidecar,
+            args.sidecar_row_group_size,
+            output_mode,
+            args.progress_interval,
+            args.stats_out,
+            stats_batches,
+        )
+        if stage_timer.enabled:
+            write_profile_summary(
+                profile_summary(time.perf_counter() - start_time), args.profile_json
+            )
+        return
+
+    # Prep output VCF
+    fout = open_record_output(args.fout, vcf.header, INFO_ADD, output_mode)
+    sidecar = None
+    if args.sidecar is not None:
+        sidecar = FrequencySidecar(
+            args.sidecar,
+            vcf.header,
+            info_ids(INFO_ADD),
+            args.sidecar_row_group_size,
+        )
+    progress = None
+    if args.progress_interval is not None:
+        progress = ProgressLogger(args.progress_interval)
+    fout = RecordWriter(fout, sidecar, progress)
+    if args.stats_out is not None:
+        annotator.stats_writer = StatsWriter(
+            args.stats_out, annotator.groups, stats_batches
+        )
+
+    # Get allele frequencies for each record & write to new VCF
+    if use_pipeline:
+        run_pipelined(
+            iter_records(vcf),
+            fout,
+            annotator,
+            args.threads,
+            args.batch_size,
+            args.queue_depth,
+        )
+    else:
+        for r in iter_records(vcf):
+            fout.write(annotator.annotate(r))
+
+    fout.close()
+    if annotator.stats is not None:
+        annotator.stats.copy_unmatched(annotator.stats_writer)
+    if annotator.stats_writer is not None:
+        annotator.stats_writer.close()
+    if output_mode == 'annotation':
+        finish_annotation_table(args.fout, INFO_ADD)
+    if stage_timer.enabled:
+        write_profile_summary(
+            profile_summary(time.perf_counter() - start_time), args.profile_json
+        )
 
 
 if __name__ == '__main__':
@@ -1,7 +1,12 @@
+import argparse
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import StrEnum
 from pathlib import Path
 
+from common.image_cache_helpers import ImageCache, list_images
 from common.image_repository_helpers import (
     DeleteVersionStatus,
     Image,
@@ -9,7 +14,6 @@ from common.image_repository_helpers import (
     add_tags,
     copy_image,
     delete_version,
-    list_images_in_repository,
     version_exists,
 )
 
@@ -17,11 +21,28 @@ logging.getLogger().setLevel(logging.INFO)
 
 SUPPORTED_REPOSITORIES = ['images']
 
+ARCHIVE_LIST_FILE = Path(__file__).parent.parent / 'archived_images.txt'
+
+
+class MoveStatus(StrEnum):
+    MOVED = 'moved'
+    # The source image couldn't be deleted, most likely because another manifest
+    # references it, so it was left where it is
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+
+@dataclass
+class MoveResult:
+    action: str
+    version_id: str
+    status: MoveStatus
+    error: str | None = None
+
 
 def get_archive_set():
-    archive_list_file = Path(__file__).parent.parent / 'archived_images.txt'
     archive_set: set[str] = set()
-    with open(archive_list_file) as f:
+    with open(ARCHIVE_LIST_FILE) as f:
         for line in f:
             archive_set.add(line.strip())
     return archive_set
@@ -47,7 +68,12 @@ def validate_archive_set(archive_set: set[str]):
             raise ValueError(f'Unsupported repository: {repo}')
 
 
-def move_image(source_image: Image, dest_image: Image, dest_repository: Repository):
+def move_image(
+    source_image: Image,
+    dest_image: Image,
+    dest_repository: Repository,
+    source_repository: Repository | None = None,
+) -> MoveStatus:
     # Check if the tags for the source image already exist in the destination repository
     # this shouldn't happen but is worth checking
     conflicting_tags = dest_repository.find_conflicting_tags(dest_image)
@@ -91,11 +117,53 @@ def move_image(source_image: Image, dest_image: Image, dest_repository: Reposito
             )
         delete_version(dest_image)
 
+    if delete_op_status == DeleteVersionStatus.FAILED_PRECONDITION:
+        return MoveStatus.SKIPPED
+
+    # Keep the repositories' indexes in step with the move for later images
+    dest_repository.add_image(dest_image)
+    if source_repository is not None:
+        source_repository.remove_image(source_image)
+    return MoveStatus.MOVED
+
+
+def run_move(
+    action: str,
+    source_image: Image,
+    dest_image: Image,
+    dest_repository: Repository,
+    source_repository: Repository,
+) -> MoveResult:
+    """
+    Move a single image, catching any error so that one failed image doesn't stop
+    the others from being moved
+    """
+    logging.info(f'{action.capitalize()} image: {source_image.active_version_id}')
+    try:
+        status = move_image(
+            source_image, dest_image, dest_repository, source_repository
+        )
+    except Exception as e:
+        logging.exception(f'Failed to move image {source_image.version_id}')
+        return MoveResult(
+            action, source_image.active_version_id, MoveStatus.FAILED, str(e)
+        )
+    return MoveResult(action, source_image.active_version_id, status)
+
 
-def archive_images_in_repository(repository: str, archive_set: set[str]):
+def archive_images_in_repository(
+    repository: str,
+    archive_set: set[str],
+    jobs: int = 1,
+    cache: ImageCache | None = None,
+) -> list[MoveResult]:
     logging.info('Getting images from repositories, this takes a while...')
-    active_images = list_images_in_repository(repository)
-    archived_images = list_images_in_repository(f'{repository}-archive')
+    archive_repository = f'{repository}-archive'
+    # Versions are copied, tagged and deleted based on these listings, so they are
+    # always listed in full rather than trusting the cache, which can miss
+    # deletions. The cache is still refreshed for the read-only scripts.
+    active_images = list_images(repository, cache, refresh=True)
+    archived_images = list_images(archive_repository, cache, refresh=True)
 
     to_archive = [
         image for image in active_images if image.active_version_id in archive_set
@@ -107,27 +175,93 @@ def archive_images_in_repository(repository: str, archive_set: set[str]):
     logging.info(f'Found {len(to_archive)} images to archive.')
     logging.info(f'Found {len(to_unarchive)} images to unarchive.')
 
-    for image in to_archive:
-        logging.info(f'Archiving image: {image.active_version_id}')
-        move_image(
-            image, image.convert_to_archived(), Repository(images=archived_images)
+    archived_repository = Repository(images=archived_images)
+    active_repository = Repository(images=active_images)
+    moves = [
+        (
+            'archiving',
+            image,
+            image.convert_to_archived(),
+            archived_repository,
+            active_repository,
         )
+        for image in to_archive
+    ]
+    moves += [
+        (
+            'unarchiving',
+            image,
+            image.convert_to_active(),
+            active_repository,
+            archived_repository,
+        )
+        for image in to_unarchive
+    ]
 
-    for image in to_unarchive:
-        logging.info(f'Unarchiving image: {image.active_version_id}')
-        move_image(image, image.convert_to_active(), Repository(images=active_images))
+    # Each image is still copied, tagged, verified and deleted in that order, but
+    # up to `jobs` images are moved at once
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda move: run_move(*move), moves))
+
+    if cache is not None and moves:
+        # The repositories track successful moves, but after a failure it's unclear
+        # which copies and deletions happened, so relist next time
+        if any(result.status == MoveStatus.FAILED for result in results):
+            cache.invalidate([repository, archive_repository])
+        else:
+            cache.update(repository, active_repository.list_images())
+            cache.update(archive_repository, archived_repository.list_images())
 
     logging.info('Done!')
+    return results
+
+
+def log_summary(results: list[MoveResult]):
+    counts = dict.fromkeys(MoveStatus, 0)
+    for result in results:
+        counts[result.status] += 1
+    logging.info(
+        f'Moved {counts[MoveStatus.MOVED]}, skipped {counts[MoveStatus.SKIPPED]} '
+        f'and failed to move {counts[MoveStatus.FAILED]} image(s).'
+    )
+    for result in results:
+        if result.status == MoveStatus.SKIPPED:
+            logging.warning(f'Skipped {result.action} {result.version_id}')
+        elif result.status == MoveStatus.FAILED:
+            logging.error(f'Failed {result.action} {result.version_id}: {result.error}')
 
 
-def archive_images():
+def archive_images(jobs: int = 1, cache: ImageCache | None = None):
     archive_set = get_archive_set()
     validate_archive_set(archive_set)
 
+    results: list[MoveResult] = []
     for repository in SUPPORTED_REPOSITORIES:
         to_archive = {img for img in archive_set if img.startswith(f'{repository}/')}
-        archive_images_in_repository(repository, to_archive)
+        results.extend(
+            archive_images_in_repository(repository, to_archive, jobs, cache)
+        )
+
+    log_summary(results)
+    failed = [r for r in results if r.status == MoveStatus.FAILED]
+    if failed:
+        raise Exception(f'Failed to move {len(failed)} image(s), see the log above.')
 
 
 if __name__ == '__main__':
-    archive_images()
+    parser = argparse.ArgumentParser(
+        description='Move images between repositories to match archived_images.txt'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=4,
+        help='Number of images to move concurrently',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the repository listing cache to save the full listings '
+        'to, for the scripts that read the cache',
+    )
+    args = parser.parse_args()
+    archive_images(args.jobs, ImageCache(args.cache_dir) if args.cache_dir else None)
@@ -0,0 +1,207 @@
+import argparse
+import datetime
+import logging
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+
+import polars as pl
+import pyarrow.parquet as pq
+from google.api_core import exceptions as gcp_exceptions
+
+from common.image_repository_helpers import (
+    Image,
+    frame_to_images,
+    images_to_frame,
+    list_image_frame,
+    list_images_in_repository,
+)
+
+DEFAULT_MAX_AGE = datetime.timedelta(days=1)
+
+# Keys of the parquet metadata that record when the listing was synced
+FULL_SYNC_KEY = b'full_sync_time'
+WATERMARK_KEY = b'watermark'
+
+
+@dataclass
+class CachedListing:
+    # A table of images, with IMAGE_SCHEMA columns
+    images: pl.DataFrame
+    # When the repository was last listed in full
+    full_sync_time: datetime.datetime
+    # The latest update_time seen, incremental refreshes list from here onwards
+    watermark: datetime.datetime | None
+
+
+class ImageCache:
+    """
+    An on-disk cache of repository listings, one parquet file per repository.
+
+    A listing is refreshed incrementally by fetching only the images updated since
+    the newest image in the cache. Incremental refreshes can't see deleted images,
+    so once the last full listing is older than `max_age` the repository is listed
+    in full again.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | os.PathLike,
+        max_age: datetime.timedelta = DEFAULT_MAX_AGE,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_age = max_age
+
+    def path(self, repository: str) -> Path:
+        return self.cache_dir / f'{repository}.parquet'
+
+    def load(self, repository: str) -> CachedListing | None:
+        "Read a repository's cached listing, or None if it isn't cached"
+        path = self.path(repository)
+        if not path.exists():
+            return None
+
+        table = pq.read_table(path)
+        metadata = table.schema.metadata or {}
+        if FULL_SYNC_KEY not in metadata:
+            logging.warning(f'Ignoring cached listing without sync times: {path}')
+            return None
+
+        watermark = metadata.get(WATERMARK_KEY)
+        return CachedListing(
+            images=pl.DataFrame(table),
+            full_sync_time=datetime.datetime.fromisoformat(
+                metadata[FULL_SYNC_KEY].decode()
+            ),
+            watermark=datetime.datetime.fromisoformat(watermark.decode())
+            if watermark
+            else None,
+        )
+
+    def store(self, repository: str, listing: CachedListing):
+        "Write a repository's listing, replacing the file in a single step"
+        metadata = {FULL_SYNC_KEY: listing.full_sync_time.isoformat().encode()}
+        if listing.watermark is not None:
+            metadata[WATERMARK_KEY] = listing.watermark.isoformat().encode()
+
+        table = listing.images.to_arrow().replace_schema_metadata(metadata)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(repository)
+        tmp_path = path.with_suffix('.parquet.tmp')
+        pq.write_table(table, tmp_path)
+        tmp_path.replace(path)
+
+    def update(self, repository: str, images: list[Image]):
+        """
+        Replace the cached images of a repository, keeping its sync times, e.g.
+        after the images have been changed by this process
+        """
+        listing = self.load(repository)
+        if listing is None:
+            return
+        listing.images = images_to_frame(images)
+        self.store(repository, listing)
+
+    def invalidate(self, repositories: Iterable[str] | None = None):
+        "Drop the cached listings of some repositories, or all of them"
+        if repositories is None:
+            paths = list(self.cache_dir.glob('*.parquet'))
+        else:
+            paths = [self.path(repository) for repository in repositories]
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def list_image_frame(self, repository: str, refresh: bool = False) -> pl.DataFrame:
+        """
+        Get a table of all images in the specified repository, using the cached
+        listing where possible. `refresh` forces a full listing.
+        """
+        now = datetime.datetime.now(datetime.UTC)
+        listing = None if refresh else self.load(repository)
+
+        if listing is not None and now - listing.full_sync_time > self.max_age:
+            logging.info(f'Cached listing of {repository} is too old, relisting')
+            listing = None
+
+        if listing is not None and listing.watermark is not None:
+            try:
+                updated = list_image_frame(repository, since=listing.watermark)
+            except gcp_exceptions.InvalidArgument as e:
+                logging.warning(f'Incremental listing of {repository} failed: {e}')
+                listing = None
+            else:
+                logging.info(
+                    f'Found {len(updated)} images updated in {repository} since '
+                    f'{listing.watermark.isoformat()}'
+                )
+                # Updated images replace their cached rows
+                listing.images = pl.concat([listing.images, updated]).unique(
+                    subset=['name', 'digest'], keep='last', maintain_order=True
+                )
+
+        if listing is None or listing.watermark is None:
+            listing = CachedListing(
+                images=list_image_frame(repository),
+                full_sync_time=now,
+                watermark=None,
+            )
+
+        listing.watermark = listing.images['update_time'].max() or listing.watermark
+        self.store(repository, listing)
+        return listing.images
+
+    def list_images(self, repository: str, refresh: bool = False) -> list[Image]:
+        "Get a list of all images in the specified repository, like `list_image_frame`"
+        return frame_to_images(self.list_image_frame(repository, refresh))
+
+
+def list_images(
+    repository: str, cache: ImageCache | None = None, refresh: bool = False
+) -> list[Image]:
+    "List a repository through `cache` if there is one, otherwise in full"
+    if cache is None:
+        return list_images_in_repository(repository)
+    return cache.list_images(repository, refresh=refresh)
+
+
+def list_images_frame(
+    repository: str, cache: ImageCache | None = None, refresh: bool = False
+) -> pl.DataFrame:
+    "Get a table of a repository's images through `cache` if there is one"
+    if cache is None:
+        return list_image_frame(repository)
+    return cache.list_image_frame(repository, refresh=refresh)
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    "Add the options that control the listing cache to a script's parser"
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory to cache repository listings in, listings are not cached '
+        'if this is not set',
+    )
+    parser.add_argument(
+        '--cache-max-age-hours',
+        type=float,
+        default=DEFAULT_MAX_AGE.total_seconds() / 3600,
+        help='Relist repositories in full once their last full listing is this old',
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        help='Ignore the cached listings and list every repository in full',
+    )
+
+
+def cache_from_args(args: argparse.Namespace) -> ImageCache | None:
+    "The ImageCache configured by `add_cache_arguments`, if caching is enabled"
+    if not args.cache_dir:
+        return None
+    cache = ImageCache(
+        args.cache_dir, datetime.timedelta(hours=args.cache_max_age_hours)
+    )
+    if args.refresh_cache:
+        cache.invalidate()
+    return cache
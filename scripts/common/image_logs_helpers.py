@@ -1,17 +1,56 @@
+import datetime
+import logging
+import os
+import uuid
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Self
+
 import polars as pl
-from google.cloud import bigquery
+import pyarrow.parquet as pq
+from common.image_repository_helpers import IMAGE_PATH_PATTERN
+from google.cloud import bigquery, bigquery_storage
 
 bq_client = bigquery.Client()
+# Reads query results as a stream of arrow record batches
+bqstorage_client = bigquery_storage.BigQueryReadClient()
+
+# Columns returned by the logs query
+LOG_QUERY_SCHEMA = {
+    'insert_id': pl.String,
+    'timestamp': pl.Datetime('us', 'UTC'),
+    'full_path': pl.String,
+    'principal_email': pl.String,
+    'principal_subject': pl.String,
+    'request_ip': pl.String,
+    'request_user_agent': pl.String,
+}
+
+# Parquet metadata key listing the part files merged into a compacted file
+COMPACTED_PARTS_KEY = b'compacted_parts'
 
+# Logs can reach the sink table some time after their timestamp, so each export
+# queries again from this long before the latest exported log
+LOG_LOOKBACK = datetime.timedelta(hours=6)
 
-def get_image_logs() -> pl.DataFrame:
+
+def query_image_logs(
+    since: datetime.datetime | None = None, ordered: bool = False
+) -> bigquery.QueryJob:
     """
-    Query bigquery table for image logs.
+    Query bigquery table for image logs, only those after `since` if it is given,
+    and sorted by timestamp if `ordered`. Each log of the sink table has the
+    `insert_id` of its log entry, which identifies it when it is queried again.
     Logs are spread across two tables because we had to manually ingest the historical
     logs into a separate table to the one that is written to by the gcp log sink.
     """
-    logs_query = """
+    since_filter = 'and timestamp > @since' if since is not None else ''
+    order_by = 'order by timestamp' if ordered else ''
+    logs_query = f"""
         select
+            -- the manually ingested logs have no insert id, and are never queried
+            -- again as they are all older than the sink table's logs
+            cast(null as string) as insert_id,
             timestamp,
             protoPayload.resourceName as full_path,
             protoPayload.authenticationInfo.principalEmail as principal_email,
@@ -20,10 +59,12 @@ def get_image_logs() -> pl.DataFrame:
             protoPayload.requestMetadata.callerSuppliedUserAgent as request_user_agent
         from cpg-common.image_logs.historical_logs
         where timestamp < (select min(timestamp) from cpg-common.image_logs.cloudaudit_googleapis_com_data_access)
+        {since_filter}
 
         UNION ALL
 
         select
+            insertId as insert_id,
             timestamp,
             protopayload_auditlog.resourceName as full_path,
             protopayload_auditlog.authenticationInfo.principalEmail as principal_email,
@@ -31,11 +72,21 @@ def get_image_logs() -> pl.DataFrame:
             protopayload_auditlog.requestMetadata.callerIp as request_ip,
             protopayload_auditlog.requestMetadata.callerSuppliedUserAgent as request_user_agent
         from cpg-common.image_logs.cloudaudit_googleapis_com_data_access
-    """
-    logs_query_job = bq_client.query(logs_query)
-    logs_rows = logs_query_job.result()
+        where true
+        {since_filter}
 
-    logs_df: pl.DataFrame = pl.from_arrow(logs_rows.to_arrow())
+        {order_by}
+    """  # noqa: S608 - only fixed clauses are formatted in, `since` is a parameter
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since)]
+        if since is not None
+        else []
+    )
+    return bq_client.query(logs_query, job_config=job_config)
+
+
+def parse_image_logs(logs_df: pl.DataFrame) -> pl.DataFrame:
+    "Split the image paths of queried logs into their parts"
     return (
         # Replace url encoded slashes with real slashes
         logs_df.with_columns(
@@ -44,8 +95,15 @@ def get_image_logs() -> pl.DataFrame:
         # Extract the project, location, repository, image and digest from the image path
         .with_columns(
             pl.col('full_path')
-            .str.extract_groups(
-                r'projects/(?<image_project>[^/]+)/locations/(?<image_location>[^/]+)/repositories/(?<image_repository>[^/]+)/dockerImages/(?<image_name>[^@]+)@sha256:(?<image_digest>.+)$'
+            .str.extract_groups(IMAGE_PATH_PATTERN)
+            .struct.rename_fields(
+                [
+                    'image_project',
+                    'image_location',
+                    'image_repository',
+                    'image_name',
+                    'image_digest',
+                ]
             )
             .alias('path_parts'),
         )
@@ -74,3 +132,245 @@ def get_image_logs() -> pl.DataFrame:
             .alias('full_path'),
         )
     )
+
+
+def iter_image_logs(
+    since: datetime.datetime | None = None, ordered: bool = False
+) -> Iterator[pl.DataFrame]:
+    """
+    Query image logs like `query_image_logs`, and parse them one record batch at a
+    time as they are read through the BigQuery Storage API
+    """
+    logs_rows = query_image_logs(since, ordered).result()
+    for batch in logs_rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        yield parse_image_logs(pl.DataFrame(batch))
+
+
+class LogWriter:
+    """
+    Write logs to a parquet file batch by batch, under a temporary name until the
+    writer is closed
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tmp_path = path.with_suffix('.parquet.tmp')
+        self._writer: pq.ParquetWriter | None = None
+        self.rows = 0
+
+    def write(self, logs_df: pl.DataFrame):
+        table = logs_df.to_arrow()
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = pq.ParquetWriter(self.tmp_path, table.schema)
+        self._writer.write_table(table)
+        self.rows += len(logs_df)
+
+    def close(self):
+        if self._writer is None:
+            # nothing was written, still leave a file with the right columns
+            self.write(parse_image_logs(pl.DataFrame(schema=LOG_QUERY_SCHEMA)))
+        assert self._writer is not None
+        self._writer.close()
+        self.tmp_path.replace(self.path)
+
+    def abort(self):
+        "Stop writing and discard the logs written so far"
+        if self._writer is not None:
+            self._writer.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *args: object) -> None:
+        # Only keep the file if all of the logs were written
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_image_logs(path: str | os.PathLike) -> int:
+    """
+    Query all image logs and write them to a parquet file without holding them in
+    memory. Returns the number of logs.
+    """
+    with LogWriter(Path(path)) as writer:
+        for logs_df in iter_image_logs():
+            writer.write(logs_df)
+    return writer.rows
+
+
+# Incremental export: logs are kept in `log_dir` as parquet files partitioned by
+# date, log_dir/date=YYYY-MM-DD/*.parquet, and each export only queries the logs
+# from LOG_LOOKBACK before the latest one already exported. Logs queried again
+# are dropped by their insert_id.
+
+
+def log_files(log_dir: str | os.PathLike) -> list[Path]:
+    return sorted(Path(log_dir).glob('date=*/*.parquet'))
+
+
+def read_log_watermark(log_dir: str | os.PathLike) -> datetime.datetime | None:
+    "The timestamp of the latest exported log, or None if nothing is exported yet"
+    files = log_files(log_dir)
+    if not files:
+        return None
+    return (
+        pl.scan_parquet(files, hive_partitioning=False)
+        .select(pl.col('timestamp').max())
+        .collect()
+        .item()
+    )
+
+
+def read_exported_ids(
+    log_dir: str | os.PathLike, since: datetime.datetime
+) -> pl.Series:
+    "The insert_ids of the exported logs after `since`"
+    files = [
+        path
+        for path in log_files(log_dir)
+        if path.parent.name >= f'date={since.date().isoformat()}'
+    ]
+    if not files:
+        return pl.Series('insert_id', [], dtype=pl.String)
+    return (
+        pl.scan_parquet(files, hive_partitioning=False)
+        .filter(pl.col('timestamp') > since, pl.col('insert_id').is_not_null())
+        .select('insert_id')
+        .collect()
+        .to_series()
+    )
+
+
+def new_log_part(partition: Path) -> LogWriter:
+    "A writer for a new file in a date partition"
+    return LogWriter(partition / f'part-{uuid.uuid4().hex}.parquet')
+
+
+def export_image_logs(
+    log_dir: str | os.PathLike, lookback: datetime.timedelta = LOG_LOOKBACK
+) -> int:
+    """
+    Query the logs after `lookback` before the export watermark and append the
+    ones not exported yet to `log_dir`, one new file per date. Returns the number
+    of new logs.
+
+    The logs are streamed in timestamp order, so only one file is written at a
+    time and every file closed before an interruption holds all of the logs of
+    its date up to the watermark. The order costs a sort of every queried log,
+    read back through a single Storage API stream: slow for the first export of
+    the whole history, but small for the later exports of the last few hours.
+    """
+    watermark = read_log_watermark(log_dir)
+    since = watermark - lookback if watermark is not None else None
+    exported = read_exported_ids(log_dir, since) if since is not None else None
+    logging.info(
+        f'Exporting image logs after {since.isoformat()}'
+        if since is not None
+        else 'Exporting all image logs'
+    )
+
+    rows = 0
+    writer: LogWriter | None = None
+    writer_date: datetime.date | None = None
+    try:
+        for logs_df in iter_image_logs(since, ordered=True):
+            new_logs = (
+                logs_df.filter(~pl.col('insert_id').is_in(exported))
+                if exported is not None
+                else logs_df
+            )
+            partitions = new_logs.with_columns(
+                pl.col('timestamp').dt.date().alias('date')
+            ).partition_by('date', as_dict=True, include_key=False)
+            for (date,), partition_df in partitions.items():
+                if writer is None or date != writer_date:
+                    if writer is not None:
+                        writer.close()
+                        rows += writer.rows
+                    writer = new_log_part(Path(log_dir) / f'date={date}')
+                    writer_date = date
+                writer.write(partition_df)
+    except BaseException:
+        # The files closed so far are complete, only the current one is dropped
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.close()
+        rows += writer.rows
+
+    logging.info(f'Exported {rows} new image logs')
+    return rows
+
+
+def finish_compaction(partition: Path):
+    """
+    Delete any part files that were merged into a compacted file but not deleted,
+    e.g. because the process stopped in between
+    """
+    for path in sorted(partition.glob('*.parquet')):
+        if not path.exists():
+            # already merged into a compacted file and deleted above
+            continue
+        metadata = pq.read_schema(path).metadata or {}
+        for part in metadata.get(COMPACTED_PARTS_KEY, b'').decode().split():
+            (partition / part).unlink(missing_ok=True)
+
+
+def compact_log_partitions(log_dir: str | os.PathLike, max_files: int = 1):
+    """
+    Merge the files of every date partition holding more than `max_files` files
+    into a single file, so that frequent exports don't leave many small files.
+    Logs with the same insert_id are only kept once.
+    """
+    for partition in sorted(Path(log_dir).glob('date=*')):
+        if len(list(partition.glob('*.parquet'))) <= max_files:
+            continue
+        finish_compaction(partition)
+        parts = sorted(partition.glob('*.parquet'))
+        if len(parts) <= max_files:
+            continue
+
+        compacted = (
+            pl.read_parquet(parts, hive_partitioning=False)
+            .filter(
+                pl.col('insert_id').is_null() | pl.col('insert_id').is_first_distinct()
+            )
+            .sort('timestamp')
+            .to_arrow()
+            .replace_schema_metadata(
+                {COMPACTED_PARTS_KEY: ' '.join(part.name for part in parts).encode()}
+            )
+        )
+        path = partition / f'part-{uuid.uuid4().hex}.parquet'
+        tmp_path = path.with_suffix('.parquet.tmp')
+        pq.write_table(compacted, tmp_path)
+        tmp_path.replace(path)
+        finish_compaction(partition)
+        logging.info(f'Compacted {len(parts)} files in {partition.name}')
+
+
+def scan_exported_logs(log_dir: str | os.PathLike) -> pl.LazyFrame:
+    "All of the logs exported to `log_dir`, in the same form as `iter_image_logs`"
+    return pl.scan_parquet(log_files(log_dir), hive_partitioning=False)
+
+
+def write_image_logs_incremental(
+    log_dir: str | os.PathLike, path: str | os.PathLike
+) -> int:
+    """
+    Export the new logs to `log_dir` and compact it, then stream all of the
+    exported logs into a single parquet file. Returns the number of new logs.
+    """
+    rows = export_image_logs(log_dir)
+    compact_log_partitions(log_dir)
+    if log_files(log_dir):
+        scan_exported_logs(log_dir).sink_parquet(path)
+    else:
+        with LogWriter(Path(path)):
+            pass
+    return rows
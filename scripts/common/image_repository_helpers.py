@@ -1,19 +1,49 @@
+import asyncio
 import datetime
+import functools
 import logging
 import re
 import shlex
 import subprocess
-from dataclasses import dataclass
+import threading
+from collections.abc import Awaitable, Coroutine, Iterable
+from dataclasses import InitVar, asdict, dataclass, field
 from enum import StrEnum
-from typing import Literal
+from typing import Any, Literal, TypeVar
 
+import polars as pl
 from google.api_core import exceptions as gcp_exceptions
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 from google.cloud import artifactregistry_v1
 from google.cloud.artifactregistry_v1.types import DockerImage
 from google.protobuf.timestamp_pb2 import Timestamp
 
-ar_client = artifactregistry_v1.ArtifactRegistryClient()
+T = TypeVar('T')
+
+# Maximum number of Artifact Registry requests in flight at once
+MAX_CONCURRENT_REQUESTS = 16
+
+# Parts of a docker image's resource name. The named groups work both with `re`
+# and with polars' `str.extract_groups`.
+IMAGE_PATH_PATTERN = (
+    r'projects/(?P<project>[^/]+)/locations/(?P<location>[^/]+)'
+    r'/repositories/(?P<repository>[^/]+)/dockerImages/(?P<name>[^@]+)@sha256:(?P<digest>.+)$'
+)
+
+# Columns of a table of images, one per Image field
+IMAGE_SCHEMA = {
+    'full_path': pl.String,
+    'build_time': pl.Datetime('us', 'UTC'),
+    'update_time': pl.Datetime('us', 'UTC'),
+    'upload_time': pl.Datetime('us', 'UTC'),
+    'size_bytes': pl.Int64,
+    'tags': pl.List(pl.String),
+    'digest': pl.String,
+    'project': pl.String,
+    'location': pl.String,
+    'repository': pl.String,
+    'name': pl.String,
+}
 
 
 # google's python types autogenerated from protobufs have incorrect types
@@ -166,10 +196,7 @@ class Image:
         """
         image_path = image_data.name.replace('%2F', '/')
 
-        name_match = re.search(
-            'projects/([^/]+)/locations/([^/]+)/repositories/([^/]+)/dockerImages/([^@]+)@sha256:(.+)$',
-            image_path,
-        )
+        name_match = re.search(IMAGE_PATH_PATTERN, image_path)
 
         if not name_match:
             raise ValueError(f'Invalid image path: {image_path}')
@@ -206,45 +233,339 @@ class Image:
         )
 
 
+def docker_images_to_frame(docker_images: Iterable[DockerImage]) -> pl.DataFrame:
+    """
+    Build a table of images straight from DockerImage objects, the columnar
+    equivalent of `Image.from_artifact_repository_image`
+    """
+    columns: dict[str, list[Any]] = {
+        'full_path': [],
+        'build_time': [],
+        'update_time': [],
+        'upload_time': [],
+        'size_bytes': [],
+        'tags': [],
+    }
+    for image_data in docker_images:
+        columns['full_path'].append(image_data.name)
+        columns['build_time'].append(image_data.build_time)
+        columns['update_time'].append(image_data.update_time)
+        columns['upload_time'].append(image_data.upload_time)
+        columns['size_bytes'].append(image_data.image_size_bytes)
+        # Filter out digest from tags, no need to double up on it
+        digest = image_data.name.rpartition('@sha256:')[2]
+        columns['tags'].append([l for l in image_data.tags if l != digest])
+
+    images = (
+        pl.DataFrame(
+            columns, schema={column: IMAGE_SCHEMA[column] for column in columns}
+        )
+        .with_columns(pl.col('full_path').str.replace_all('%2F', '/', literal=True))
+        .with_columns(
+            pl.col('full_path')
+            .str.extract_groups(IMAGE_PATH_PATTERN)
+            .alias('path_parts')
+        )
+        .unnest('path_parts')
+    )
+
+    invalid_paths = images.filter(pl.col('digest').is_null())['full_path']
+    if len(invalid_paths):
+        raise ValueError(f'Invalid image path: {invalid_paths[0]}')
+
+    return images.select(IMAGE_SCHEMA.keys())
+
+
+def images_to_frame(images: Iterable[Image]) -> pl.DataFrame:
+    "Build a table of images from Image objects"
+    return pl.DataFrame([asdict(image) for image in images], schema=IMAGE_SCHEMA)
+
+
+def frame_to_images(images: pl.DataFrame) -> list[Image]:
+    "Get the Image objects for each row of a table of images"
+    return [Image(**row) for row in images.iter_rows(named=True)]
+
+
+def active_image_columns(images: pl.DataFrame) -> pl.DataFrame:
+    """
+    Swap the archived repository and paths of archived images for what they were
+    while active, the columnar equivalent of the Image `active_*` properties
+    """
+    active_repository = pl.col('repository').str.strip_suffix('-archive')
+    return images.with_columns(
+        pl.col('full_path').str.replace(
+            '-archive/dockerImages', '/dockerImages', literal=True
+        ),
+        active_repository.alias('repository'),
+        pl.when(pl.col('repository').str.ends_with('-archive'))
+        .then(pl.lit('archived'))
+        .otherwise(pl.lit('active'))
+        .alias('status'),
+        pl.concat_str([active_repository, pl.col('name')], separator='/').alias(
+            'short_path'
+        ),
+    )
+
+
 @dataclass
 class Repository:
-    images: list[Image]
+    """
+    The images in a repository, indexed by version and by tag. Use `add_image`
+    and `remove_image` to change the repository, so that the indexes stay in
+    step with each other, and `list_images` to get its images.
+    """
+
+    images: InitVar[list[Image]]
+    # (name, digest) -> image version
+    _versions: dict[tuple[str, str], Image] = field(
+        init=False, repr=False, compare=False
+    )
+    # name -> tag -> digest, tags being unique within an image name
+    _tags: dict[str, dict[str, str]] = field(init=False, repr=False, compare=False)
+    # (name, digest) -> tags pointing at that version
+    _version_tags: dict[tuple[str, str], set[str]] = field(
+        init=False, repr=False, compare=False
+    )
+    _lock: threading.Lock = field(
+        init=False, repr=False, compare=False, default_factory=threading.Lock
+    )
+
+    def __post_init__(self, images: list[Image]) -> None:
+        self._versions = {}
+        self._tags = {}
+        self._version_tags = {}
+        for image in images:
+            self._index(image)
+
+    def _index(self, image: Image) -> None:
+        key = (image.name, image.digest)
+        self._versions.setdefault(key, image)
+        name_tags = self._tags.setdefault(image.name, {})
+        for tag in image.tags:
+            previous = name_tags.get(tag)
+            if previous is not None and previous != image.digest:
+                # the tag has moved from another version
+                self._version_tags[(image.name, previous)].discard(tag)
+            name_tags[tag] = image.digest
+            self._version_tags.setdefault(key, set()).add(tag)
+
+    def list_images(self) -> list[Image]:
+        "All image versions in the repository"
+        with self._lock:
+            return list(self._versions.values())
+
+    def add_image(self, image: Image) -> None:
+        "Add an image version to the repository, e.g. once it has been copied in"
+        with self._lock:
+            self._index(image)
+
+    def remove_image(self, image: Image) -> None:
+        "Remove an image version from the repository, e.g. once it has been deleted"
+        with self._lock:
+            key = (image.name, image.digest)
+            self._versions.pop(key, None)
+            name_tags = self._tags.get(image.name, {})
+            for tag in self._version_tags.pop(key, set()):
+                del name_tags[tag]
 
     def includes_image_version(self, image: Image):
         """
         Check if this repository already has a certain version of an image
         """
 
-        return any(
-            i.name == image.name and i.digest == image.digest for i in self.images
-        )
+        return (image.name, image.digest) in self._versions
 
     def find_conflicting_tags(self, image: Image):
         """
         Check if there are any other images in the repository with the same
         name and same tags but different digest
         """
-        conflicting_tags: set[str] = set()
-
-        for i in self.images:
-            if i.name == image.name and i.digest != image.digest:
-                conflicting_tags.update(set(i.tags) & set(image.tags))
+        name_tags = self._tags.get(image.name, {})
+        conflicting_tags = {
+            tag
+            for tag in image.tags
+            if name_tags.get(tag, image.digest) != image.digest
+        }
 
         return list(conflicting_tags)
 
 
+class DeleteVersionStatus(StrEnum):
+    SUCCESS = 'success'
+    FAILED_PRECONDITION = 'failed_precondition'
+
+
+class ArtifactRegistry:
+    """
+    Asynchronous Artifact Registry operations sharing a single async client.
+
+    The client lives on its own event loop in a background thread, so the same
+    instance can be used from synchronous code in any thread via `run`, and at
+    most `max_concurrent_requests` requests are in flight however many
+    operations are started at once.
+    """
+
+    def __init__(self, max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='artifact-registry', daemon=True
+        )
+        self._thread.start()
+        # The async client has to be created on the loop it is used from
+        self._client: artifactregistry_v1.ArtifactRegistryAsyncClient = self.run(
+            self._create_client()
+        )
+        self._requests = asyncio.Semaphore(max_concurrent_requests)
+
+    @staticmethod
+    async def _create_client() -> artifactregistry_v1.ArtifactRegistryAsyncClient:
+        return artifactregistry_v1.ArtifactRegistryAsyncClient()
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        "Run a coroutine on the registry's event loop and wait for its result"
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def gather(self, coroutines: Iterable[Awaitable[T]]) -> list[T]:
+        "Run many coroutines concurrently and wait for all of their results"
+
+        async def gather_all() -> list[T]:
+            return await asyncio.gather(*coroutines)
+
+        return self.run(gather_all())
+
+    async def list_docker_images(
+        self, repository: str, since: datetime.datetime | None = None
+    ) -> list[DockerImage]:
+        """
+        Get the DockerImages in the specified repository. If `since` is given, only
+        the images updated at or after it are returned. They are listed newest first
+        so only the pages holding recently updated images are fetched.
+        """
+        request = artifactregistry_v1.ListDockerImagesRequest(
+            parent=f'projects/cpg-common/locations/australia-southeast1/repositories/{repository}',
+        )
+        if since is not None:
+            request.order_by = 'update_time desc'
+
+        docker_images: list[DockerImage] = []
+        async with self._requests:
+            page_result = await self._client.list_docker_images(request=request)
+            async for response in page_result:
+                update_time = image_timestamp_to_datetime(response.update_time)
+                if (
+                    since is not None
+                    and update_time is not None
+                    and update_time < since
+                ):
+                    break
+                docker_images.append(response)
+        return docker_images
+
+    async def list_images_in_repository(self, repository: str):
+        """
+        Get a list of all images in the specifiec repository.
+        returns a list of Image dataclass instances
+        """
+        return [
+            Image.from_artifact_repository_image(response)
+            for response in await self.list_docker_images(repository)
+        ]
+
+    async def add_tag(self, image: Image, tag: str):
+        try:
+            logging.info(f'Adding tag {tag} to image {image.version_id}')
+            # Create the request to add the tag
+            request = artifactregistry_v1.CreateTagRequest(
+                parent=image.gcp_package_resource_name,
+                tag_id=tag,
+                tag=artifactregistry_v1.Tag(
+                    name=image.get_gcp_tag_resource_name(tag),
+                    version=image.gcp_version_resource_name,
+                ),
+            )
+
+            async with self._requests:
+                await self._client.create_tag(request=request)
+
+            logging.info(f'Successfully added tag {tag} to image {image.version_id}')
+        except gcp_exceptions.AlreadyExists as already_exists_err:
+            logging.warning(
+                f'Tag {tag} already exists for image {image.version_id}: {already_exists_err}'
+            )
+        except Exception as e:
+            logging.error(f'Failed to add tag {tag} to image {image.version_id}: {e}')
+            raise e
+
+    async def add_tags(self, image: Image, tags: list[str]):
+        "Add tags to an existing image, creating all of them at once"
+        await asyncio.gather(*(self.add_tag(image, tag) for tag in tags))
+
+    async def delete_version(self, image: Image):
+        "Delete an image version"
+
+        try:
+            request = artifactregistry_v1.DeleteVersionRequest(
+                name=image.gcp_version_resource_name,
+                force=True,  # delete even if it is tagged
+            )
+            async with self._requests:
+                operation = await self._client.delete_version(request=request)
+                await operation.result()
+
+            logging.info(f'Successfully deleted image: {image.version_id}')
+            return DeleteVersionStatus.SUCCESS
+        except gcp_exceptions.FailedPrecondition as failed_precondition_err:
+            # https://cloud.google.com/sdk/gcloud/reference/artifacts/versions/delete
+            # This FailedPrecondition error can happen for a number of reasons, but in our
+            # case the most likely is that the image is referenced by another manifest
+            # in this case we don't want to move the image as it is still "in use"
+            logging.warning(
+                f'Image {image.version_id} failed precondition check: {failed_precondition_err}'
+            )
+            return DeleteVersionStatus.FAILED_PRECONDITION
+        except Exception as e:
+            logging.error(f'Failed to delete image {image.version_id}: {e}')
+            raise e
+
+    async def version_exists(self, image: Image):
+        try:
+            request = artifactregistry_v1.GetVersionRequest(
+                name=image.gcp_version_resource_name,
+            )
+            async with self._requests:
+                await self._client.get_version(request=request)
+            return True
+        except gcp_exceptions.NotFound:
+            return False
+
+
+@functools.cache
+def get_registry() -> ArtifactRegistry:
+    "The shared ArtifactRegistry, created on first use"
+    return ArtifactRegistry()
+
+
+# Synchronous API, each call waits for the shared ArtifactRegistry
+
+
 def list_images_in_repository(repository: str):
     """
     Get a list of all images in the specifiec repository.
     returns a list of Image dataclass instances
     """
+    registry = get_registry()
+    return registry.run(registry.list_images_in_repository(repository))
 
-    request = artifactregistry_v1.ListDockerImagesRequest(
-        parent=f'projects/cpg-common/locations/australia-southeast1/repositories/{repository}',
-    )
 
-    page_result = ar_client.list_docker_images(request=request)
-    return [Image.from_artifact_repository_image(response) for response in page_result]
+def list_image_frame(repository: str, since: datetime.datetime | None = None):
+    """
+    Get a table of the images in the specified repository, or only of those updated
+    at or after `since`, without creating an Image for each of them
+    """
+    registry = get_registry()
+    return docker_images_to_frame(
+        registry.run(registry.list_docker_images(repository, since))
+    )
 
 
 def copy_image(source: str, destination: str):
@@ -272,73 +593,34 @@ def copy_image(source: str, destination: str):
 
 
 def add_tag(image: Image, tag: str):
-    try:
-        logging.info(f'Adding tag {tag} to image {image.version_id}')
-        # Create the request to add the tag
-        request = artifactregistry_v1.CreateTagRequest(
-            parent=image.gcp_package_resource_name,
-            tag_id=tag,
-            tag=artifactregistry_v1.Tag(
-                name=image.get_gcp_tag_resource_name(tag),
-                version=image.gcp_version_resource_name,
-            ),
-        )
-
-        ar_client.create_tag(request=request)
-
-        logging.info(f'Successfully added tag {tag} to image {image.version_id}')
-    except gcp_exceptions.AlreadyExists as already_exists_err:
-        logging.warning(
-            f'Tag {tag} already exists for image {image.version_id}: {already_exists_err}'
-        )
-    except Exception as e:
-        logging.error(f'Failed to add tag {tag} to image {image.version_id}: {e}')
-        raise e
+    registry = get_registry()
+    registry.run(registry.add_tag(image, tag))
 
 
 def add_tags(image: Image, tags: list[str]):
     "Add tags to an existing image"
-    for tag in tags:
-        add_tag(image, tag)
-
-
-class DeleteVersionStatus(StrEnum):
-    SUCCESS = 'success'
-    FAILED_PRECONDITION = 'failed_precondition'
+    registry = get_registry()
+    registry.run(registry.add_tags(image, tags))
 
 
 def delete_version(image: Image):
     "Delete an image version"
-
-    try:
-        request = artifactregistry_v1.DeleteVersionRequest(
-            name=image.gcp_version_resource_name,
-            force=True,  # delete even if it is tagged
-        )
-        ar_client.delete_version(request=request).result()
-
-        logging.info(f'Successfully deleted image: {image.version_id}')
-        return DeleteVersionStatus.SUCCESS
-    except gcp_exceptions.FailedPrecondition as failed_precondition_err:
-        # https://cloud.google.com/sdk/gcloud/reference/artifacts/versions/delete
-        # This FailedPrecondition error can happen for a number of reasons, but in our
-        # case the most likely is that the image is referenced by another manifest
-        # in this case we don't want to move the image as it is still "in use"
-        logging.warning(
-            f'Image {image.version_id} failed precondition check: {failed_precondition_err}'
-        )
-        return DeleteVersionStatus.FAILED_PRECONDITION
-    except Exception as e:
-        logging.error(f'Failed to delete image {image.version_id}: {e}')
-        raise e
+    registry = get_registry()
+    return registry.run(registry.delete_version(image))
 
 
 def version_exists(image: Image):
-    try:
-        request = artifactregistry_v1.GetVersionRequest(
-            name=image.gcp_version_resource_name,
-        )
-        ar_client.get_version(request=request)
-        return True
-    except gcp_exceptions.NotFound:
-        return False
+    registry = get_registry()
+    return registry.run(registry.version_exists(image))
+
+
+def versions_exist(images: list[Image]) -> list[bool]:
+    "Check whether each of many image versions exists, concurrently"
+    registry = get_registry()
+    return registry.gather(registry.version_exists(image) for image in images)
+
+
+def delete_versions(images: list[Image]) -> list[DeleteVersionStatus]:
+    "Delete many image versions concurrently"
+    registry = get_registry()
+    return registry.gather(registry.delete_version(image) for image in images)
@@ -0,0 +1,84 @@
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+import polars as pl
+
+
+def daily_pulls(logs: pl.LazyFrame) -> pl.LazyFrame:
+    "Pulls of each image version per day"
+    return (
+        logs.group_by(
+            'full_path',
+            'short_path',
+            pl.col('image_digest').alias('digest'),
+            pl.col('timestamp').dt.date().alias('date'),
+        )
+        .agg(pl.len().alias('pulls'))
+        .sort('short_path', 'digest', 'date')
+    )
+
+
+def version_pulls(logs: pl.LazyFrame) -> pl.LazyFrame:
+    "Total, first and most recent pulls of each image version"
+    return (
+        logs.group_by('full_path', 'short_path', pl.col('image_digest').alias('digest'))
+        .agg(
+            pl.len().alias('total_pulls'),
+            pl.col('timestamp').min().alias('first_pull'),
+            pl.col('timestamp').max().alias('most_recent_pull'),
+        )
+        .sort('short_path', 'digest')
+    )
+
+
+def image_principals(logs: pl.LazyFrame) -> pl.LazyFrame:
+    "Number of distinct principals that have pulled any version of each image"
+    return (
+        logs.group_by('short_path')
+        .agg(pl.col('principal_email').n_unique().alias('principals'))
+        .sort('short_path')
+    )
+
+
+def repository_storage(images: pl.LazyFrame) -> pl.LazyFrame:
+    "Number of image versions and bytes stored per repository, active and archived"
+    return (
+        images.group_by('repository', 'status')
+        .agg(
+            pl.len().alias('versions'),
+            pl.col('size_bytes').sum().alias('size_bytes'),
+        )
+        .sort('repository', 'status')
+    )
+
+
+# Rollups of the logs and of the images, by the name of the file they are written
+# to. They are small enough for the statistics dashboard to load instead of the
+# full log history, and are joined to the images on their active `full_path`.
+LOG_ROLLUPS: dict[str, Callable[[pl.LazyFrame], pl.LazyFrame]] = {
+    'daily_pulls': daily_pulls,
+    'version_pulls': version_pulls,
+    'image_principals': image_principals,
+}
+IMAGE_ROLLUPS: dict[str, Callable[[pl.LazyFrame], pl.LazyFrame]] = {
+    'repository_storage': repository_storage,
+}
+
+
+def write_rollups(
+    logs: pl.LazyFrame, images: pl.LazyFrame, data_dir: str | os.PathLike
+) -> list[Path]:
+    "Compute every rollup and write each one to `data_dir/<name>.parquet`"
+    queries = {name: rollup(logs) for name, rollup in LOG_ROLLUPS.items()}
+    queries |= {name: rollup(images) for name, rollup in IMAGE_ROLLUPS.items()}
+
+    # Collecting the rollups together lets polars share the scans between them
+    results = pl.collect_all(list(queries.values()), engine='streaming')
+
+    paths = []
+    for name, result in zip(queries, results, strict=True):
+        path = Path(data_dir) / f'{name}.parquet'
+        result.write_parquet(path)
+        paths.append(path)
+    return paths
@@ -1,48 +1,58 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import polars as pl
-from common.image_logs_helpers import get_image_logs
-from common.image_repository_helpers import Image, list_images_in_repository
+from common.image_cache_helpers import (
+    ImageCache,
+    add_cache_arguments,
+    cache_from_args,
+    list_images_frame,
+)
+from common.image_logs_helpers import write_image_logs, write_image_logs_incremental
+from common.image_repository_helpers import active_image_columns
+from common.image_usage_helpers import write_rollups
 
 repositories = ['images', 'images-dev', 'images-archive']
 
 
-def get_image_stats():
-    # get the logs first as it is much faster than getting the images
-    logs_df = get_image_logs()
+def get_image_stats(cache: ImageCache | None = None, log_dir: str | None = None):
+    data_dir = Path(__file__).parent / 'image_statistics/src/data'
+    logs_path = data_dir / 'logs.parquet'
+
+    # The log export and the repository listings are independent, so run them all at
+    # once and only wait as long as the slowest of them. The logs are streamed
+    # straight into their parquet file rather than held in memory.
+    with ThreadPoolExecutor(max_workers=len(repositories) + 1) as executor:
+        logs_future = (
+            executor.submit(write_image_logs_incremental, log_dir, logs_path)
+            if log_dir
+            else executor.submit(write_image_logs, logs_path)
+        )
+        listing_futures = [
+            executor.submit(list_images_frame, repo, cache) for repo in repositories
+        ]
 
-    all_images: list[Image] = []
-    for repo in repositories:
-        all_images.extend(list_images_in_repository(repo))
+        image_frames = [listing_future.result() for listing_future in listing_futures]
+        logs_future.result()
 
     # get the image data, use "active" fields so it can be best compared to the logs
-    images_df = pl.DataFrame(
-        [
-            {
-                'full_path': image.active_full_path,
-                'build_time': image.build_time,
-                'update_time': image.update_time,
-                'upload_time': image.upload_time,
-                'size_bytes': image.size_bytes,
-                'tags': image.tags,
-                'digest': image.digest,
-                'project': image.project,
-                'location': image.location,
-                'repository': image.active_repository,
-                'name': image.name,
-                'status': image.status,
-                'short_path': image.active_short_path,
-            }
-            for image in all_images
-        ]
-    )
-    logs_df.write_parquet(
-        Path(__file__).parent / 'image_statistics/src/data/logs.parquet'
-    )
-    images_df.write_parquet(
-        Path(__file__).parent / 'image_statistics/src/data/images.parquet'
-    )
+    images_df = active_image_columns(pl.concat(image_frames))
+    images_df.write_parquet(data_dir / 'images.parquet')
+
+    # Pre-aggregate the logs for the dashboard, scanning the logs file lazily
+    write_rollups(pl.scan_parquet(logs_path), images_df.lazy(), data_dir)
 
 
 if __name__ == '__main__':
-    get_image_stats()
+    parser = argparse.ArgumentParser(
+        description='Export image logs and listings for the image statistics site'
+    )
+    parser.add_argument(
+        '--log-dir',
+        help='Directory to keep exported logs in, so that only new logs are queried. '
+        'All logs are queried each time if this is not set',
+    )
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    get_image_stats(cache_from_args(args), args.log_dir)
@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import difflib
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+import polars as pl
+from archive_images import ARCHIVE_LIST_FILE, SUPPORTED_REPOSITORIES
+from common.image_cache_helpers import (
+    ImageCache,
+    add_cache_arguments,
+    cache_from_args,
+    list_images_frame,
+)
+from common.image_logs_helpers import (
+    compact_log_partitions,
+    export_image_logs,
+    log_files,
+    scan_exported_logs,
+    write_image_logs,
+)
+from common.image_repository_helpers import active_image_columns
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Tag of the version that should always stay active
+LATEST_TAG = 'latest'
+
+
+def rank_archive_candidates(
+    images: pl.LazyFrame,
+    logs: pl.LazyFrame,
+    now: datetime.datetime,
+    unpulled_days: int,
+    keep_tags: int,
+) -> pl.LazyFrame:
+    """
+    Find the active image versions that can be archived, most stale and largest
+    first. A version is a candidate if it hasn't been pulled in `unpulled_days`,
+    or uploaded in that time if it was never pulled, and it is either untagged or
+    not among the latest `keep_tags` tagged versions of its image.
+    """
+    last_pulls = logs.group_by(
+        'short_path', pl.col('image_digest').alias('digest')
+    ).agg(pl.col('timestamp').max().alias('last_pull'))
+
+    tagged = pl.col('tags').list.len() > 0
+    stale = pl.coalesce('last_pull', 'upload_time', 'update_time') < (
+        now - datetime.timedelta(days=unpulled_days)
+    )
+
+    return (
+        images.filter(
+            pl.col('status') == 'active',
+            pl.col('repository').is_in(SUPPORTED_REPOSITORIES),
+        )
+        .join(last_pulls, on=['short_path', 'digest'], how='left')
+        .with_columns(
+            tagged.alias('tagged'),
+            # 1 for the most recently uploaded tagged version of each image
+            pl.coalesce('upload_time', 'update_time')
+            .rank('ordinal', descending=True)
+            .over('short_path', tagged)
+            .alias('tag_rank'),
+        )
+        .with_columns(
+            pl.when(~pl.col('tagged'))
+            .then(pl.lit('untagged'))
+            .when(pl.col('tag_rank') > keep_tags)
+            .then(pl.lit(f'not in latest {keep_tags} tags'))
+            .alias('reason'),
+        )
+        .filter(
+            stale,
+            pl.col('reason').is_not_null(),
+            ~pl.col('tags').list.contains(LATEST_TAG),
+        )
+        .select(
+            pl.concat_str(
+                [pl.col('short_path'), pl.lit('@sha256:'), pl.col('digest')]
+            ).alias('version_id'),
+            'reason',
+            'last_pull',
+            'upload_time',
+            'size_bytes',
+            'tags',
+        )
+        .sort(
+            ['last_pull', 'size_bytes'],
+            descending=[False, True],
+            nulls_last=False,
+        )
+    )
+
+
+def scan_logs(logs_path: str | None, log_dir: str | None, tmp_dir: str) -> pl.LazyFrame:
+    """
+    Scan the image logs from a parquet file or exported log directory, otherwise
+    export the new logs to `log_dir` or stream all of them into `tmp_dir` first
+    """
+    if logs_path:
+        path = Path(logs_path)
+        return (
+            scan_exported_logs(path)
+            if path.is_dir() and log_files(path)
+            else pl.scan_parquet(path)
+        )
+
+    if log_dir:
+        export_image_logs(log_dir)
+        compact_log_partitions(log_dir)
+        return scan_exported_logs(log_dir)
+
+    write_image_logs(Path(tmp_dir) / 'logs.parquet')
+    return pl.scan_parquet(Path(tmp_dir) / 'logs.parquet')
+
+
+def propose_archive_candidates(
+    logs: pl.LazyFrame,
+    unpulled_days: int,
+    keep_tags: int,
+    cache: ImageCache | None = None,
+) -> pl.DataFrame:
+    "List the supported repositories and rank the archive candidates among them"
+    images = active_image_columns(
+        pl.concat([list_images_frame(repo, cache) for repo in SUPPORTED_REPOSITORIES])
+    )
+    return rank_archive_candidates(
+        images.lazy(),
+        logs,
+        datetime.datetime.now(datetime.UTC),
+        unpulled_days,
+        keep_tags,
+    ).collect()
+
+
+def write_proposal(candidates: pl.DataFrame, write: bool = False):
+    """
+    Add the candidates that aren't listed yet to the end of the archive list, and
+    either update the list or print the change as a diff
+    """
+    with open(ARCHIVE_LIST_FILE) as f:
+        current = f.read().splitlines(keepends=True)
+
+    listed = {line.strip() for line in current}
+    new_candidates = candidates.filter(~pl.col('version_id').is_in(listed))
+    proposed = current + [f'{line}\n' for line in sorted(new_candidates['version_id'])]
+
+    with pl.Config(tbl_rows=50, fmt_str_lengths=80):
+        logging.info(
+            f'Archive candidates, most stale and largest first:\n{new_candidates}'
+        )
+    reclaimed_gb = new_candidates['size_bytes'].sum() / 1024 / 1024 / 1024
+    logging.info(
+        f'Proposing {len(new_candidates)} of {len(candidates)} candidates, '
+        f'reclaiming {reclaimed_gb:.2f} GB'
+    )
+
+    if write:
+        with open(ARCHIVE_LIST_FILE, 'w') as f:
+            f.writelines(proposed)
+    else:
+        sys.stdout.writelines(
+            difflib.unified_diff(
+                current, proposed, 'a/archived_images.txt', 'b/archived_images.txt'
+            )
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Propose image versions to add to archived_images.txt based on '
+        'how recently they were pulled'
+    )
+    parser.add_argument(
+        '--unpulled-days',
+        type=int,
+        default=180,
+        help='Only propose versions that have not been pulled in this many days',
+    )
+    parser.add_argument(
+        '--keep-tags',
+        type=int,
+        default=3,
+        help='Never propose the latest this many tagged versions of each image',
+    )
+    parser.add_argument(
+        '--logs',
+        help='Parquet file or exported log directory to read the image logs from, '
+        'e.g. the logs.parquet written by get_image_statistics.py',
+    )
+    parser.add_argument(
+        '--log-dir',
+        help='Directory to export the new image logs to before reading them',
+    )
+    parser.add_argument(
+        '--write',
+        action='store_true',
+        help='Update archived_images.txt rather than printing a diff',
+    )
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        candidates = propose_archive_candidates(
+            scan_logs(args.logs, args.log_dir, tmp_dir),
+            args.unpulled_days,
+            args.keep_tags,
+            cache_from_args(args),
+        )
+    write_proposal(candidates, args.write)